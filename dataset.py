@@ -0,0 +1,308 @@
+"""
+Test case records and datasets of them indexed per problem without loading everything up front.
+
+Records are slim dicts (make_record), read_record also reads the legacy 9- and 11-tuples.
+
+Record files (pkl) are either one pickled list or a record stream: one pickle per record with an index of
+byte offsets and feasible flags next to it, so that single records are read without unpickling the file.
+
+Packed on-disk dataset: the records of pkl/npz test case files stored as flat arrays with offset tables,
+one .npy file per array in a directory, memory-mapped on load.
+"""
+import argparse
+import json
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+PACKED_VERSION = 2
+# schema of the records written by the test case generators, legacy records are tuples
+RECORD_VERSION = 2
+
+# variable length per problem, stored flat with an offset table
+RAGGED_FIELDS = ['points', 'edge_index', 'path', 'voxel_half_extents', 'voxel_base_positions']
+OBS_FIELDS = ['init_states', 'goal_states', 'obs_pos', 'obs_ori', 'obs_traj', 'obs_points']
+# one value per problem
+SCALAR_FIELDS = ['feasible', 'plan_time', 'end_time', 'collision_check']
+# record index of a record stream file, next to it
+INDEX_SUFFIX = '.index.npz'
+
+
+def is_packed(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def is_stream(path):
+    return os.path.exists(path + INDEX_SUFFIX)
+
+
+def make_record(points, edge_index, path, feasible, end_time, collision_check, half_extents=None,
+                base_positions=None, plan_time=None, sipp_state=None):
+    """
+    Slim test case record.
+    sipp_state: (arr_time, prev, safe_intervals) of the SIPP search, only kept for debugging
+    """
+    record = {'version': RECORD_VERSION, 'points': points, 'edge_index': edge_index, 'path': path,
+              'feasible': feasible, 'end_time': end_time, 'collision_check': collision_check,
+              'half_extents': half_extents, 'base_positions': base_positions, 'plan_time': plan_time,
+              'arr_time': None, 'prev': None, 'safe_intervals': None}
+    if sipp_state is not None:
+        record['arr_time'], record['prev'], record['safe_intervals'] = sipp_state
+    return record
+
+
+def read_record(record):
+    """
+    Fields of a record of any schema as a slim record.
+    Legacy records are the 9-tuples (points, edge_index, arr_time, prev, safe_intervals, path, feasible, end_time,
+    collision_check) and, with voxels, the 11-tuples (points, edge_index, half_extents, base_positions, arr_time,
+    prev, safe_intervals, path, plan_time, end_time, collision_check). The baseline training loop read the
+    plan_time of the 11-tuples as the feasible flag, the generators only kept feasible cases.
+    """
+    if isinstance(record, dict):
+        if record['version'] != RECORD_VERSION:
+            raise RuntimeError(f'Error: record version {record["version"]}')
+        return record
+
+    if len(record) == 11:
+        points, edge_index, half_extents, base_positions, arr_time, prev, safe_intervals, path, plan_time, \
+            end_time, collision_check = record
+        return make_record(points, edge_index, path, bool(plan_time), end_time, collision_check, half_extents,
+                           base_positions, plan_time, (arr_time, prev, safe_intervals))
+
+    points, edge_index, arr_time, prev, safe_intervals, path, feasible, end_time, collision_check = record
+    return make_record(points, edge_index, path, feasible, end_time, collision_check,
+                       sipp_state=(arr_time, prev, safe_intervals))
+
+
+def write_records(path, records):
+    """
+    Write the records (any iterable) as a record stream with its index.
+    Both files are written next to their destination first, so an existing file is replaced only once complete.
+    """
+    offsets = [0]
+    feasible = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, pickle.DEFAULT_PROTOCOL)
+            offsets.append(f.tell())
+            feasible.append(read_record(record)['feasible'])
+    tmp_index_path = path + '.tmp' + INDEX_SUFFIX
+    np.savez(tmp_index_path, offsets=np.array(offsets, dtype=np.int64), feasible=np.array(feasible, dtype=bool))
+
+    # the records first: a stream without an index is rejected on load, a pickled list with one is not
+    os.replace(tmp_path, path)
+    os.replace(tmp_index_path, path + INDEX_SUFFIX)
+
+
+def load_records(path):
+    """
+    All records of a record file of either layout
+    """
+    with open(path, 'rb') as f:
+        if not is_stream(path):
+            records = pickle.load(f)
+            if not isinstance(records, list) or f.read(1):
+                raise RuntimeError(f'Error: {path} is a record stream without its index {path + INDEX_SUFFIX}')
+            return records
+        with np.load(path + INDEX_SUFFIX) as index:
+            num_records = len(index['feasible'])
+        return [pickle.load(f) for _ in range(num_records)]
+
+
+def feasible_flags(graphs):
+    """
+    Feasibility of every record, taken from the index of lazy and packed datasets instead of the records
+    """
+    if isinstance(graphs, (LazyDataset, PackedDataset)):
+        return graphs.feasible
+    return np.array([read_record(record)['feasible'] for record in graphs], dtype=bool)
+
+
+def pack_dataset(data_path_graph, data_path_obs, out_path):
+    """
+    Convert the pkl/npz pairs into one packed dataset in the directory out_path.
+    The SIPP search state (arr_time, prev, safe_intervals) is not kept.
+    """
+    ragged = {name: [] for name in RAGGED_FIELDS}
+    scalars = {name: [] for name in SCALAR_FIELDS}
+    obs = {name: [] for name in OBS_FIELDS}
+    voxels = False
+    num_problems = 0
+
+    for graph_file, obs_file in zip(data_path_graph, data_path_obs):
+        records = load_records(graph_file)
+
+        for record in records:
+            record = read_record(record)
+            voxels = record['half_extents'] is not None
+            ragged['points'].append(np.asarray(record['points']))
+            ragged['edge_index'].append(np.asarray(record['edge_index'], dtype=np.int64).reshape(-1, 2))
+            ragged['path'].append(np.asarray(record['path'], dtype=np.int64).reshape(-1, 2))
+            if voxels:
+                ragged['voxel_half_extents'].append(np.asarray(record['half_extents'], dtype=float).reshape(-1, 3))
+                ragged['voxel_base_positions'].append(np.asarray(record['base_positions'], dtype=float).reshape(-1, 3))
+            for name in SCALAR_FIELDS:
+                # one value per problem, NaN where the record has none (e.g. plan_time of legacy records)
+                scalars[name].append(np.nan if record[name] is None else record[name])
+        num_problems += len(records)
+
+        with np.load(obs_file) as f:
+            for name in OBS_FIELDS:
+                if name in f:
+                    obs[name].append(f[name])
+        print(f'{graph_file} packed')
+
+    os.makedirs(out_path, exist_ok=True)
+    meta = {'version': PACKED_VERSION, 'num_problems': num_problems, 'voxels': voxels,
+            'ragged': [], 'scalars': [], 'obs': []}
+
+    for name, items in ragged.items():
+        if not items:
+            continue
+        offsets = np.concatenate(([0], np.cumsum([len(item) for item in items])))
+        np.save(os.path.join(out_path, f'{name}.npy'), np.concatenate(items))
+        np.save(os.path.join(out_path, f'{name}_offsets.npy'), offsets)
+        meta['ragged'].append(name)
+
+    for name, values in scalars.items():
+        values = np.array(values)
+        if np.isnan(values.astype(float)).all():
+            continue
+        np.save(os.path.join(out_path, f'{name}.npy'), values)
+        meta['scalars'].append(name)
+
+    for name, values in obs.items():
+        # only the obstacle arrays every file has
+        if len(values) == len(data_path_obs):
+            np.save(os.path.join(out_path, f'{name}.npy'), np.concatenate(values))
+            meta['obs'].append(name)
+
+    with open(os.path.join(out_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print(f'{num_problems} problems saved to {out_path}')
+
+
+class PackedDataset():
+    """
+    Slim records of a packed dataset, without the SIPP search state.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != PACKED_VERSION:
+            raise RuntimeError(f'Error: packed dataset version {self.meta["version"]} of {path}')
+
+        names = [name for field in self.meta['ragged'] for name in (field, f'{field}_offsets')]
+        names += self.meta['scalars'] + self.meta['obs']
+        self.arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+
+    def __len__(self):
+        return self.meta['num_problems']
+
+    def ragged(self, name, index):
+        offsets = self.arrays[f'{name}_offsets']
+        return np.array(self.arrays[name][offsets[index]:offsets[index + 1]])
+
+    def scalar(self, name, index):
+        value = self.arrays[name][index].item()
+        # missing values are stored as NaN
+        return None if isinstance(value, float) and np.isnan(value) else value
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        points = self.ragged('points', index)
+        edge_index = self.ragged('edge_index', index)
+        path = [tuple(step) for step in self.ragged('path', index).tolist()]
+        scalars = {name: self.scalar(name, index) for name in self.meta['scalars']}
+
+        if self.meta['voxels']:
+            scalars['half_extents'] = self.ragged('voxel_half_extents', index)
+            scalars['base_positions'] = self.ragged('voxel_base_positions', index)
+        return make_record(points, edge_index, path, **scalars)
+
+    @property
+    def feasible(self):
+        return np.asarray(self.arrays['feasible'], dtype=bool)
+
+    def obs_setting(self):
+        return {name: self.arrays[name] for name in self.meta['obs']}
+
+
+class LazyDataset():
+    """
+    Records of record stream files, each record is read from its byte offset when it is indexed.
+    The feasible flags of all records are read from the indexes up front.
+    cache_size: number of decoded records kept in memory (LRU), 0 reads a record on every access
+    """
+    def __init__(self, data_path_graph, cache_size=0):
+        self.data_path_graph = data_path_graph
+        self.record_offsets = []
+        feasible = []
+        for path in data_path_graph:
+            if not is_stream(path):
+                raise RuntimeError(f'Error: {path} has no record index, convert it with dataset.py --stream')
+            with np.load(path + INDEX_SUFFIX) as f:
+                self.record_offsets.append(f['offsets'])
+                feasible.append(f['feasible'])
+        self.feasible = np.concatenate(feasible)
+        self.offsets = np.concatenate(([0], np.cumsum([len(flags) for flags in feasible]))).astype(int)
+        self.files = {}
+        self.cache_size = cache_size
+        self.records = OrderedDict()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index in self.records:
+            self.records.move_to_end(index)
+            return self.records[index]
+
+        file_idx = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        if file_idx not in self.files:
+            self.files[file_idx] = open(self.data_path_graph[file_idx], 'rb')
+        f = self.files[file_idx]
+        f.seek(self.record_offsets[file_idx][index - self.offsets[file_idx]])
+        record = pickle.load(f)
+
+        if self.cache_size:
+            self.records[index] = record
+            if len(self.records) > self.cache_size:
+                self.records.popitem(last=False)
+        return record
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        self.records.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack pkl/npz test case files into a memory-mappable dataset, '
+                                                 'or convert pkl files to record streams')
+    parser.add_argument('--graph', type=str, nargs='+', required=True, help='pkl files of the records')
+    parser.add_argument('--obs', type=str, nargs='+', help='npz files of the obstacles, same order')
+    parser.add_argument('--out', type=str, help='output directory')
+    parser.add_argument('--stream', action='store_true', help='rewrite the pkl files as record streams in place')
+    args = parser.parse_args()
+
+    if args.stream:
+        for graph_file in args.graph:
+            write_records(graph_file, load_records(graph_file))
+            print(f'{graph_file} converted')
+    else:
+        pack_dataset(args.graph, args.obs, args.out)
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import pybullet as p
+
+# pybullet reports contacts up to the contact breaking threshold, boxes are padded by it
+AABB_MARGIN = 0.02
+
+
+@lru_cache(maxsize=None)
+def bisection_order(K):
+    '''
+    Interpolation indices 1..K in bisection (van der Corput) order: K, K/2, K/4, 3K/4, ...
+    A collision anywhere on an edge is found after a few checks instead of a sweep from the start.
+    '''
+    if K < 1:
+        return ()
+    order = [K]
+    intervals = [(0, K)]
+    while intervals:
+        next_intervals = []
+        for low, high in intervals:
+            if high - low < 2:
+                continue
+            mid = (low + high) // 2
+            order.append(mid)
+            next_intervals += [(low, mid), (mid, high)]
+        intervals = next_intervals
+    return tuple(order)
+
+
+def interpolation_order(K, bisection=False):
+    '''
+    Order in which the interpolation points k=1..K of an edge are checked
+    '''
+    if bisection:
+        return bisection_order(K)
+    return range(1, K + 1)
+
+
+def link_aabbs(body_ids, margin=AABB_MARGIN, client=0):
+    '''
+    Axis-aligned bounding boxes of all links of the bodies in their current pose, [L, 2, 3] of (lower, upper)
+    '''
+    aabbs = [p.getAABB(body_id, link, physicsClientId=client)
+             for body_id in body_ids for link in range(-1, p.getNumJoints(body_id, physicsClientId=client))]
+    aabbs = np.array(aabbs, dtype=float)
+    aabbs[:, 0] -= margin
+    aabbs[:, 1] += margin
+    return aabbs
+
+
+def aabb_overlap(a, b):
+    '''
+    a: [..., La, 2, 3], b: [Lb, 2, 3]
+    returns [...] whether any box of a overlaps any box of b
+    '''
+    lower = np.maximum(a[..., :, None, 0, :], b[:, 0, :])
+    upper = np.minimum(a[..., :, None, 1, :], b[:, 1, :])
+    return (lower <= upper).all(-1).any((-1, -2))
+
+
+class BroadPhase():
+    '''
+    Bounding box broad phase in front of the narrow phase (performCollisionDetection).
+    Link boxes of a body are read from pybullet again only after it moved, so the static scene is read once
+    and the obstacle arms once per pose (time tick) instead of once per check.
+    verify: run the narrow phase as well and fail when the broad phase reports a colliding configuration free
+    '''
+    def __init__(self, client=0, margin=AABB_MARGIN, verify=False):
+        self.client = client
+        self.margin = margin
+        self.verify = verify
+        self.body_ids = None
+        self.aabbs = {}
+        self.poses = {}
+        self.num_checks, self.num_skipped = 0, 0
+
+    def invalidate(self):
+        # bodies were added, removed or moved without moved()
+        self.body_ids = None
+        self.aabbs.clear()
+        self.poses.clear()
+
+    def moved(self, body_id, config):
+        pose = np.asarray(config, dtype=float).tobytes()
+        if self.poses.get(body_id) != pose:
+            self.poses[body_id] = pose
+            self.aabbs.pop(body_id, None)
+
+    def body_aabbs(self, body_id):
+        if body_id not in self.aabbs:
+            self.aabbs[body_id] = link_aabbs((body_id,), self.margin, self.client)
+        return self.aabbs[body_id]
+
+    def free(self, body_ids, narrow_free=None):
+        '''
+        Whether the bodies certainly have no contact with any other body in the simulation:
+        no link box of them overlaps a link box of a different body. False only means the narrow phase is needed.
+        narrow_free: the narrow phase check, only called when verify is set
+        '''
+        if self.body_ids is None:
+            self.body_ids = [p.getBodyUniqueId(i, physicsClientId=self.client)
+                             for i in range(p.getNumBodies(physicsClientId=self.client))]
+        self.num_checks += 1
+
+        for i, body_id in enumerate(body_ids):
+            for other_id in self.body_ids:
+                # pairs within body_ids are tested once
+                if other_id == body_id or other_id in body_ids[:i]:
+                    continue
+                if aabb_overlap(self.body_aabbs(body_id), self.body_aabbs(other_id)):
+                    return False
+
+        self.num_skipped += 1
+        if self.verify and not narrow_free():
+            raise RuntimeError(f'Error: broad phase reported a configuration in collision as free '
+                               f'after {self.num_checks} checks')
+        return True
+
+
+def contact_free(body_ids, exclude_ids=(), client=0):
+    '''
+    Whether the bodies have no contact points except with the bodies in exclude_ids.
+    Call after p.performCollisionDetection().
+    '''
+    for body_id in body_ids:
+        for contact in p.getContactPoints(body_id, physicsClientId=client):
+            if contact[2] not in exclude_ids:
+                return False
+    return True
+
+
+class CollisionCache():
+    '''
+    Size-bounded LRU memo of collision check results, keyed by quantized configurations
+    and the obstacle time tick. size=0 disables the cache.
+    '''
+    def __init__(self, size=0, resolution=1e-6):
+        self.size = size
+        self.resolution = resolution
+        self.results = OrderedDict()
+
+    def key(self, configs, time=None):
+        config = np.concatenate([np.ravel(c) for c in configs])
+        return np.round(config / self.resolution).astype(np.int64).tobytes(), time
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
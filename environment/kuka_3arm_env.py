@@ -1,20 +1,19 @@
 import pybullet as p
 import numpy as np
 
+from environment.collision import interpolation_order, BroadPhase, contact_free, CollisionCache
+
 class Env:
     def __init__(self,cfg,  GUI=False):
-        try:
-            p.disconnect()
-        except:
-            pass
+        # every environment owns its pybullet client, several can exist in one process
         if GUI:
-            p.connect(p.GUI, options='--background_color_red=0.97 --background_color_green=0.97 --background_color_blue=1.0')
-            p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0, [1, -1, -1])
-            p.resetDebugVisualizerCamera(2., 25, -20, (0.5, 0.5, 0.5))
+            self.client = p.connect(p.GUI, options='--background_color_red=0.97 --background_color_green=0.97 --background_color_blue=1.0')
+            p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0, [1, -1, -1], physicsClientId=self.client)
+            p.resetDebugVisualizerCamera(2., 25, -20, (0.5, 0.5, 0.5), physicsClientId=self.client)
 
         else:
-            p.connect(p.DIRECT)
-        p.setGravity(0, 0, -10)
+            self.client = p.connect(p.DIRECT)
+        p.setGravity(0, 0, -10, physicsClientId=self.client)
 
         self.config_dim = cfg['env']['config_dim']
         self.workspace_dim = cfg['env']['workspace_dim']
@@ -30,14 +29,32 @@ class Env:
         self.create_env()
         self.episode_i = 0
         self.speed = 1/(cfg['env']['unit_timestep']-1)
+        # keep the loaded arms between problems and only swap the voxels instead of reloading the scene
+        self.REUSE_ENV = cfg['env'].get('REUSE_ENV', False)
         self.CC_EPS = cfg['env']['CC_EPS']
+        # check the interpolation points of an edge in bisection order instead of from start to end
+        self.CC_BISECTION = cfg['env'].get('CC_BISECTION', False)
+        # certify clearly free configurations from link bounding boxes before the narrow phase
+        self.CC_BROAD_PHASE = cfg['env'].get('CC_BROAD_PHASE', False)
+        # run the narrow phase as well and fail on a broad phase false negative, to validate it on a dataset
+        self.broad_phase = BroadPhase(self.client, verify=cfg['env'].get('CC_BROAD_PHASE_VERIFY', False)) \
+            if self.CC_BROAD_PHASE else None
         self.RRT_EPS = cfg['env']['RRT_EPS']
+        # memo of collision check results, reused across planner retries on the same problem
+        self.cc_cache = CollisionCache(cfg['env'].get('CC_CACHE_SIZE', 0))
+        self.collision_cache_hits, self.collision_cache_misses = 0, 0
         self.collision_check_count = 0
         self.end_effector_index = 6
 
 
+    def close(self):
+        p.disconnect(physicsClientId=self.client)
+
     def init_new_problem(self, file=None, index=None, setting_dict=None):
-        self.create_env()
+        if self.REUSE_ENV:
+            self.remove_voxels()
+        else:
+            self.create_env()
         # when training
         if file:
             with np.load(file) as f:
@@ -46,6 +63,7 @@ class Env:
                 self.obs_poss = f['obs_pos']
                 self.obs_oris = f['obs_ori']
                 self.obs_trajs = f['obs_traj']
+                self.obs_pointss = f['obs_points'] if 'obs_points' in f else None
 
         elif setting_dict:
             self.init_states = setting_dict['init_states']
@@ -53,6 +71,7 @@ class Env:
             self.obs_poss = setting_dict['obs_pos']
             self.obs_oris = setting_dict['obs_ori']
             self.obs_trajs = setting_dict['obs_traj']
+            self.obs_pointss = setting_dict.get('obs_points', None)
 
         else:
             raise RuntimeError('Error environment input')
@@ -73,37 +92,62 @@ class Env:
         # obs_traj [T x 7*2]
         self.obs_traj = self.obs_trajs[self.order[index]]
 
-        # get workspace points for traj
-        self.obs_points = np.array([self.get_workspace_points(c) for c in self.obs_traj]).reshape(-1,self.workspace_dim)
+        # get workspace points for traj, precomputed in the dataset when available
+        if self.obs_pointss is not None:
+            self.obs_points = self.obs_pointss[self.order[index]]
+        else:
+            self.obs_points = self.get_obs_points(self.obs_traj)
 
         self.episode_i += 1
         self.episode_i = (self.episode_i) % len(self.order)
         self.collision_check_count = 0
+        self.collision_cache_hits, self.collision_cache_misses = 0, 0
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
 
     def create_env(self):
-        p.resetSimulation()
-
-        stick_mine = p.loadURDF(self.arm_file_mine, self.arm_mine_base_pos, self.arm_mine_base_ori, useFixedBase=True)
-        stick_obs_1 = p.loadURDF(self.arm_file_obs, self.arm_obs_1_base_pos, self.arm_obs_1_base_ori, useFixedBase=True)
-        stick_obs_2 = p.loadURDF(self.arm_file_obs, self.arm_obs_2_base_pos, self.arm_obs_2_base_ori, useFixedBase=True)
+        p.resetSimulation(physicsClientId=self.client)
+        self.invalidate_broad_phase()
+        self.obs_config = np.zeros(0)
+        self.voxel_ids = []
+
+        stick_mine = p.loadURDF(self.arm_file_mine, self.arm_mine_base_pos, self.arm_mine_base_ori, useFixedBase=True, physicsClientId=self.client)
+        stick_obs_1 = p.loadURDF(self.arm_file_obs, self.arm_obs_1_base_pos, self.arm_obs_1_base_ori, useFixedBase=True, physicsClientId=self.client)
+        stick_obs_2 = p.loadURDF(self.arm_file_obs, self.arm_obs_2_base_pos, self.arm_obs_2_base_ori, useFixedBase=True, physicsClientId=self.client)
         self.stick_mine, self.stick_obs_1, self.stick_obs_2 = stick_mine, stick_obs_1, stick_obs_2
+        self.mine_ids, self.obs_ids = (stick_mine,), (stick_obs_1, stick_obs_2)
 
 
     def create_voxel(self, halfExtents, basePosition):
-        groundColId = p.createCollisionShape(p.GEOM_BOX, halfExtents=halfExtents)
+        groundColId = p.createCollisionShape(p.GEOM_BOX, halfExtents=halfExtents, physicsClientId=self.client)
         groundVisID = p.createVisualShape(shapeType=p.GEOM_BOX,
                                           rgbaColor=np.random.uniform(0, 1, size=3).tolist() + [0.8],
                                           specularColor=[0.4, .4, 0],
-                                          halfExtents=halfExtents)
+                                          halfExtents=halfExtents, physicsClientId=self.client)
         groundId = p.createMultiBody(baseMass=0,
                                      baseCollisionShapeIndex=groundColId,
                                      baseVisualShapeIndex=groundVisID,
-                                     basePosition=basePosition)
+                                     basePosition=basePosition, physicsClientId=self.client)
+        self.voxel_ids.append(groundId)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
         return groundId
 
+    def remove_voxel(self, body_id):
+        p.removeBody(body_id, physicsClientId=self.client)
+        self.voxel_ids.remove(body_id)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
+
+    def remove_voxels(self):
+        for body_id in list(self.voxel_ids):
+            self.remove_voxel(body_id)
+
     def resetBaseOrientation(self, base, orientation):
-        p.resetBasePositionAndOrientation(self.stick_obs_1, base[:3], orientation[:4])
-        p.resetBasePositionAndOrientation(self.stick_obs_2, base[3:], orientation[4:])
+        p.resetBasePositionAndOrientation(self.stick_obs_1, base[:3], orientation[:4], physicsClientId=self.client)
+        p.resetBasePositionAndOrientation(self.stick_obs_2, base[3:], orientation[4:], physicsClientId=self.client)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
 
     def uniform_sample_mine(self, n=1):
         '''
@@ -140,39 +184,58 @@ class Env:
             return sample
 
     def set_config_mine(self, config):
-        for i in range(len(config)):
-            p.resetJointState(self.stick_mine, i, config[i])
+        self.reset_joints(self.stick_mine, config)
 
     def set_config_obs(self, config):
-        config_obs_1 = config[:self.config_dim]
-        config_obs_2 = config[self.config_dim:]
-        for i in range(len(config_obs_1)):
-            p.resetJointState(self.stick_obs_1, i, config_obs_1[i])
-            p.resetJointState(self.stick_obs_2, i, config_obs_2[i])
+        self.reset_joints(self.stick_obs_1, config[:self.config_dim])
+        self.reset_joints(self.stick_obs_2, config[self.config_dim:])
+        if len(config) > 0:
+            self.obs_config = config
 
     def set_config_2arm(self, config, arm_id1, arm_id2):
-        config_obs_1 = config[:self.config_dim]
-        config_obs_2 = config[self.config_dim:]
-        for i in range(len(config_obs_1)):
-            p.resetJointState(arm_id1, i, config_obs_1[i])
-            p.resetJointState(arm_id2, i, config_obs_2[i])
+        self.reset_joints(arm_id1, config[:self.config_dim])
+        self.reset_joints(arm_id2, config[self.config_dim:])
+
+    def reset_joints(self, body_id, config):
+        # all joints of an arm in one pybullet call
+        if len(config) > 0:
+            p.resetJointStatesMultiDof(body_id, list(range(len(config))), [[c] for c in config], physicsClientId=self.client)
+            if self.broad_phase is not None:
+                self.broad_phase.moved(body_id, config)
+
+    def invalidate_broad_phase(self):
+        if self.broad_phase is not None:
+            self.broad_phase.invalidate()
 
     def set_config_arm(self, config, arm_id):
-        for i in range(len(config)):
-            p.resetJointState(arm_id, i, config[i])
+        self.reset_joints(arm_id, config)
 
 
     def check_collision(self):
-        p.performCollisionDetection()
-        if len(p.getContactPoints(self.stick_mine)) == 0:
+        if self.broad_phase is not None and self.broad_phase.free(self.mine_ids, self.narrow_phase_free):
+            return True
+        return self.narrow_phase_free()
+
+    def narrow_phase_free(self):
+        p.performCollisionDetection(physicsClientId=self.client)
+        if len(p.getContactPoints(self.stick_mine, physicsClientId=self.client)) == 0:
             return True
         else:
             return False
 
 
+    def check_collision_split(self):
+        '''
+        check_collision without the contacts between mine and the obstacle arms
+        returns (mine free of everything else, obstacle arms free of everything else)
+        contacts of the obstacle arms are not part of check_collision here, so the latter is always True
+        '''
+        p.performCollisionDetection(physicsClientId=self.client)
+        return contact_free(self.mine_ids, self.obs_ids, client=self.client), True
+
     def check_collision_body(self, body_id):
-        p.performCollisionDetection()
-        if len(p.getContactPoints(body_id)) == 0:
+        p.performCollisionDetection(physicsClientId=self.client)
+        if len(p.getContactPoints(body_id, physicsClientId=self.client)) == 0:
             return True
         else:
             return False
@@ -201,17 +264,23 @@ class Env:
 
         return True
 
+    def get_obs_points(self, obs_traj):
+        '''
+        Workspace points of the obstacle arms along a trajectory, [T, workspace_dim]
+        '''
+        return np.array([self.get_workspace_points(c) for c in obs_traj]).reshape(-1, self.workspace_dim)
+
     def get_workspace_points(self, obsconfig, relative=False):
         points = []
         self.set_config_obs(obsconfig)
 
         for effector in range(self.config_dim):
-            point = p.getLinkState(self.stick_obs_1, effector)[0]
+            point = p.getLinkState(self.stick_obs_1, effector, physicsClientId=self.client)[0]
             point = (point[0], point[1], point[2])
             points.append(point)
 
         for effector in range(self.config_dim):
-            point = p.getLinkState(self.stick_obs_2, effector)[0]
+            point = p.getLinkState(self.stick_obs_2, effector, physicsClientId=self.client)[0]
             point = (point[0], point[1], point[2])
             points.append(point)
 
@@ -221,16 +290,49 @@ class Env:
         points = []
         self.set_config_mine(mineconfig)
         for effector in range(self.config_dim):
-            point = p.getLinkState(self.stick_mine, effector)[0]
+            point = p.getLinkState(self.stick_mine, effector, physicsClientId=self.client)[0]
             point = (point[0], point[1], point[2])
             points.append(point)
         return np.array(points).reshape((-1))
 
     def _state_fp(self, mineconfig):
         self.set_config_mine(mineconfig)
-        return self.check_collision()
+        if not self.cc_cache.size:
+            return self.check_collision()
+
+        key = self.cc_cache.key((mineconfig[:self.config_dim], self.obs_config))
+        free = self.cc_cache.get(key)
+        if free is None:
+            self.collision_cache_misses += 1
+            free = self.check_collision()
+            self.cc_cache.put(key, free)
+        else:
+            self.collision_cache_hits += 1
+        return free
 
     def _edge_fp(self, state, new_state, cur_time):
+        if not self.cc_cache.size:
+            return self._check_edge(state, new_state, cur_time)
+
+        max_time = self.obs_points.shape[0] - 1
+        key = self.cc_cache.key((state, new_state), min(int(cur_time), max_time))
+        free = self.cc_cache.get(key)
+        if free is None:
+            self.collision_cache_misses += 1
+            free = self._check_edge(state, new_state, cur_time)
+            self.cc_cache.put(key, free)
+        else:
+            self.collision_cache_hits += 1
+            if free:
+                # leave both arms at the last pose _check_edge would have checked
+                d = np.linalg.norm(new_state - state)
+                K = max(int(np.ceil(d / self.speed)), 1)
+                k = interpolation_order(K, self.CC_BISECTION)[-1]
+                self.set_config_mine(state + k * 1. / K * (new_state - state))
+                self.set_config_obs(self.obs_traj[min(int(cur_time) + k, max_time)])
+        return free
+
+    def _check_edge(self, state, new_state, cur_time):
         assert state.size == new_state.size
         self.collision_check_count += 1
 
@@ -250,7 +352,7 @@ class Env:
             return False
 
         # mine moving
-        for k in range(1, K + 1):
+        for k in interpolation_order(K, self.CC_BISECTION):
             c_mine = state + k * 1. / K * disp_mine
             self.set_config_mine(c_mine)
 
@@ -262,6 +364,20 @@ class Env:
 
         return True
 
+    def check_edges(self, states, new_states, cur_times, stop_at_free=False):
+        '''
+        _edge_fp of several edges states[i] -> new_states[i] leaving at cur_times[i], checked in the given order
+        through the collision cache and in the interpolation order of _edge_fp.
+        stop_at_free: only look for the first collision-free edge, the edges after it are not checked
+        returns [num_edges] bool, False for edges that were not checked
+        '''
+        free = np.zeros(len(states), dtype=bool)
+        for i, (state, new_state, cur_time) in enumerate(zip(states, new_states, cur_times)):
+            free[i] = self._edge_fp(state, new_state, cur_time)
+            if free[i] and stop_at_free:
+                break
+        return free
+
     def distance(self, from_state, to_state):
         '''
         Distance metric
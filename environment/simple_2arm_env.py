@@ -2,20 +2,19 @@ import pybullet as p
 import numpy as np
 import pybullet_data
 
+from environment.collision import interpolation_order, BroadPhase, contact_free, CollisionCache
+
 
 class Env:
     def __init__(self, cfg, GUI=False):
-        try:
-            p.disconnect()
-        except:
-            pass
+        # every environment owns its pybullet client, several can exist in one process
         if GUI:
-            p.connect(p.GUI, options='--background_color_red=0.97 --background_color_green=0.97 --background_color_blue=1')
-            p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0)
-            p.resetDebugVisualizerCamera(2., 50, -20, (0.5, 0.5, 0.5))
+            self.client = p.connect(p.GUI, options='--background_color_red=0.97 --background_color_green=0.97 --background_color_blue=1')
+            p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0, physicsClientId=self.client)
+            p.resetDebugVisualizerCamera(2., 50, -20, (0.5, 0.5, 0.5), physicsClientId=self.client)
         else:
-            p.connect(p.DIRECT)
-        p.setGravity(0, 0, -10)
+            self.client = p.connect(p.DIRECT)
+        p.setGravity(0, 0, -10, physicsClientId=self.client)
         self.config_dim = cfg['env']['config_dim']
         self.workspace_dim = cfg['env']['workspace_dim']
         self.arm_file_mine = cfg['env']['arm_file']
@@ -28,14 +27,32 @@ class Env:
         self.create_env()
         self.episode_i = 0
         self.speed = 1/(cfg['env']['unit_timestep']-1)
+        # keep the loaded arms between problems and only swap the voxels instead of reloading the scene
+        self.REUSE_ENV = cfg['env'].get('REUSE_ENV', False)
         self.CC_EPS = cfg['env']['CC_EPS']
+        # check the interpolation points of an edge in bisection order instead of from start to end
+        self.CC_BISECTION = cfg['env'].get('CC_BISECTION', False)
+        # certify clearly free configurations from link bounding boxes before the narrow phase
+        self.CC_BROAD_PHASE = cfg['env'].get('CC_BROAD_PHASE', False)
+        # run the narrow phase as well and fail on a broad phase false negative, to validate it on a dataset
+        self.broad_phase = BroadPhase(self.client, verify=cfg['env'].get('CC_BROAD_PHASE_VERIFY', False)) \
+            if self.CC_BROAD_PHASE else None
         self.RRT_EPS = cfg['env']['RRT_EPS']
+        # memo of collision check results, reused across planner retries on the same problem
+        self.cc_cache = CollisionCache(cfg['env'].get('CC_CACHE_SIZE', 0))
+        self.collision_cache_hits, self.collision_cache_misses = 0, 0
         self.collision_check_count = 0
         self.end_effector_index = 2
 
 
+    def close(self):
+        p.disconnect(physicsClientId=self.client)
+
     def init_new_problem(self, file=None, index=None, setting_dict=None):
-        self.create_env()
+        if self.REUSE_ENV:
+            self.remove_voxels()
+        else:
+            self.create_env()
         # when training
         if file:
             with np.load(file) as f:
@@ -44,6 +61,7 @@ class Env:
                 self.obs_poss = f['obs_pos']
                 self.obs_oris = f['obs_ori']
                 self.obs_trajs = f['obs_traj']
+                self.obs_pointss = f['obs_points'] if 'obs_points' in f else None
 
         elif setting_dict:
             self.init_states = setting_dict['init_states']
@@ -51,6 +69,7 @@ class Env:
             self.obs_poss = setting_dict['obs_pos']
             self.obs_oris = setting_dict['obs_ori']
             self.obs_trajs = setting_dict['obs_traj']
+            self.obs_pointss = setting_dict.get('obs_points', None)
 
         else:
             raise RuntimeError('Error: environment input')
@@ -71,23 +90,35 @@ class Env:
         # obs_traj
         self.obs_traj = self.obs_trajs[self.order[index]]
 
-        # get workspace points for traj
-        self.obs_points = np.array([self.get_workspace_points(c) for c in self.obs_traj]).reshape(-1, self.workspace_dim)
+        # get workspace points for traj, precomputed in the dataset when available
+        if self.obs_pointss is not None:
+            self.obs_points = self.obs_pointss[self.order[index]]
+        else:
+            self.obs_points = self.get_obs_points(self.obs_traj)
 
         self.episode_i += 1
         self.episode_i = (self.episode_i) % len(self.order)
         self.collision_check_count = 0
+        self.collision_cache_hits, self.collision_cache_misses = 0, 0
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
 
 
     def create_env(self):
-        p.resetSimulation()
-        stick1 = p.loadURDF(self.arm_file_mine, self.arm_mine_base_pos, self.arm_mine_base_ori, useFixedBase=True)
-        stick2 = p.loadURDF(self.arm_file_obs, self.arm_obs_base_pos, self.arm_obs_base_ori, useFixedBase=True)
+        p.resetSimulation(physicsClientId=self.client)
+        self.invalidate_broad_phase()
+        self.obs_config = np.zeros(0)
+        self.voxel_ids = []
+        stick1 = p.loadURDF(self.arm_file_mine, self.arm_mine_base_pos, self.arm_mine_base_ori, useFixedBase=True, physicsClientId=self.client)
+        stick2 = p.loadURDF(self.arm_file_obs, self.arm_obs_base_pos, self.arm_obs_base_ori, useFixedBase=True, physicsClientId=self.client)
         self.stick1, self.stick2 = stick1, stick2
+        self.mine_ids, self.obs_ids = (stick1,), (stick2,)
 
 
     def resetBaseOrientation(self, base, orientation):
-        p.resetBasePositionAndOrientation(self.stick2, base, orientation)
+        p.resetBasePositionAndOrientation(self.stick2, base, orientation, physicsClientId=self.client)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
 
     def uniform_sample_mine(self, n=1):
         '''
@@ -113,30 +144,59 @@ class Env:
         self.set_config_mine(config[:self.config_dim])
         self.set_config_obs(config[self.config_dim:])
 
+    def reset_joints(self, body_id, config):
+        # all joints of an arm in one pybullet call
+        if len(config) > 0:
+            p.resetJointStatesMultiDof(body_id, list(range(len(config))), [[c] for c in config], physicsClientId=self.client)
+            if self.broad_phase is not None:
+                self.broad_phase.moved(body_id, config)
+
+    def invalidate_broad_phase(self):
+        if self.broad_phase is not None:
+            self.broad_phase.invalidate()
+
     def set_config_arm(self, config, arm_id):
-        for i in range(len(config)):
-            p.resetJointState(arm_id, i, config[i])
+        self.reset_joints(arm_id, config)
 
     def set_config_mine(self, config):
-        for i in range(len(config)):
-            p.resetJointState(self.stick1, i, config[i])
+        self.reset_joints(self.stick1, config)
 
     def set_config_obs(self, config):
-        for i in range(len(config)):
-            p.resetJointState(self.stick2, i, config[i])
+        self.reset_joints(self.stick2, config)
+        if len(config) > 0:
+            self.obs_config = config
 
     def check_collision(self):
-        p.performCollisionDetection()
-        if (len(p.getContactPoints(self.stick1)) == 0) and (len(p.getContactPoints(self.stick2)) == 0):
+        if self.broad_phase is not None and self.broad_phase.free(self.mine_ids + self.obs_ids, self.narrow_phase_free):
+            return True
+        return self.narrow_phase_free()
+
+    def narrow_phase_free(self):
+        p.performCollisionDetection(physicsClientId=self.client)
+        if (len(p.getContactPoints(self.stick1, physicsClientId=self.client)) == 0) and (len(p.getContactPoints(self.stick2, physicsClientId=self.client)) == 0):
             return True
         else:
             return False
 
+    def check_collision_split(self):
+        '''
+        check_collision without the contacts between mine and the obstacle arm
+        returns (mine free of everything else, obstacle arm free of everything else)
+        '''
+        p.performCollisionDetection(physicsClientId=self.client)
+        return contact_free(self.mine_ids, self.obs_ids, client=self.client), contact_free(self.obs_ids, self.mine_ids, client=self.client)
+
+    def get_obs_points(self, obs_traj):
+        '''
+        Workspace points of the obstacle arms along a trajectory, [T, workspace_dim]
+        '''
+        return np.array([self.get_workspace_points(c) for c in obs_traj]).reshape(-1, self.workspace_dim)
+
     def get_workspace_points(self, obsconfig, relative=False):
         points = []
         self.set_config_obs(obsconfig)
         for effector in range(3):
-            point = p.getLinkState(self.stick2, effector)[0]
+            point = p.getLinkState(self.stick2, effector, physicsClientId=self.client)[0]
             point = (point[0], point[1], point[2])
             points.append(point)
         return np.array(points).reshape((-1))
@@ -145,28 +205,74 @@ class Env:
         points = []
         self.set_config_mine(mineconfig)
         for effector in range(3):
-            point = p.getLinkState(self.stick1, effector)[0]
+            point = p.getLinkState(self.stick1, effector, physicsClientId=self.client)[0]
             point = (point[0], point[1], point[2])
             points.append(point)
         return np.array(points).reshape((-1))
 
     def create_voxel(self, halfExtents, basePosition):
-        groundColId = p.createCollisionShape(p.GEOM_BOX, halfExtents=halfExtents)
+        groundColId = p.createCollisionShape(p.GEOM_BOX, halfExtents=halfExtents, physicsClientId=self.client)
         groundVisID = p.createVisualShape(shapeType=p.GEOM_BOX,
                                           rgbaColor=np.random.uniform(0, 1, size=3).tolist() + [0.8],
                                           specularColor=[0.4, .4, 0],
-                                          halfExtents=halfExtents)
+                                          halfExtents=halfExtents, physicsClientId=self.client)
         groundId = p.createMultiBody(baseMass=0,
                                      baseCollisionShapeIndex=groundColId,
                                      baseVisualShapeIndex=groundVisID,
-                                     basePosition=basePosition)
+                                     basePosition=basePosition, physicsClientId=self.client)
+        self.voxel_ids.append(groundId)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
         return groundId
 
+    def remove_voxel(self, body_id):
+        p.removeBody(body_id, physicsClientId=self.client)
+        self.voxel_ids.remove(body_id)
+        self.cc_cache.clear()
+        self.invalidate_broad_phase()
+
+    def remove_voxels(self):
+        for body_id in list(self.voxel_ids):
+            self.remove_voxel(body_id)
+
     def _state_fp(self, config):
         self.set_config(config)
-        return self.check_collision()
+        if not self.cc_cache.size:
+            return self.check_collision()
+
+        key = self.cc_cache.key((config[:self.config_dim], self.obs_config))
+        free = self.cc_cache.get(key)
+        if free is None:
+            self.collision_cache_misses += 1
+            free = self.check_collision()
+            self.cc_cache.put(key, free)
+        else:
+            self.collision_cache_hits += 1
+        return free
 
     def _edge_fp(self, state, new_state, cur_time):
+        if not self.cc_cache.size:
+            return self._check_edge(state, new_state, cur_time)
+
+        max_time = self.obs_points.shape[0] - 1
+        key = self.cc_cache.key((state, new_state), min(int(cur_time), max_time))
+        free = self.cc_cache.get(key)
+        if free is None:
+            self.collision_cache_misses += 1
+            free = self._check_edge(state, new_state, cur_time)
+            self.cc_cache.put(key, free)
+        else:
+            self.collision_cache_hits += 1
+            if free:
+                # leave both arms at the last pose _check_edge would have checked
+                d = np.linalg.norm(new_state - state)
+                K = max(int(np.ceil(d / self.speed)), 1)
+                k = interpolation_order(K, self.CC_BISECTION)[-1]
+                self.set_config_mine(state + k * 1. / K * (new_state - state))
+                self.set_config_obs(self.obs_traj[min(int(cur_time) + k, max_time)])
+        return free
+
+    def _check_edge(self, state, new_state, cur_time):
         assert state.size == new_state.size
         self.collision_check_count += 1
 
@@ -185,7 +291,7 @@ class Env:
 
         if d == 0: K=1
         self.collision_check_count += d // self.CC_EPS
-        for k in range(1, K + 1):
+        for k in interpolation_order(K, self.CC_BISECTION):
             c_mine = state + k * 1. / K * disp_mine
             self.set_config_mine(c_mine)
 
@@ -197,6 +303,19 @@ class Env:
 
         return True
 
+    def check_edges(self, states, new_states, cur_times, stop_at_free=False):
+        '''
+        _edge_fp of several edges states[i] -> new_states[i] leaving at cur_times[i], checked in the given order
+        through the collision cache and in the interpolation order of _edge_fp.
+        stop_at_free: only look for the first collision-free edge, the edges after it are not checked
+        returns [num_edges] bool, False for edges that were not checked
+        '''
+        free = np.zeros(len(states), dtype=bool)
+        for i, (state, new_state, cur_time) in enumerate(zip(states, new_states, cur_times)):
+            free[i] = self._edge_fp(state, new_state, cur_time)
+            if free[i] and stop_at_free:
+                break
+        return free
 
     def distance(self, from_state, to_state):
         '''
@@ -322,9 +441,10 @@ class Env:
     def plot(self, path, make_gif=False):
         path = np.array(path)
 
-        p.resetSimulation()
+        p.resetSimulation(physicsClientId=self.client)
+        self.invalidate_broad_phase()
 
-        p.setAdditionalSearchPath(pybullet_data.getDataPath())
+        p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=self.client)
 
         # p.loadURDF("plane.urdf", [0, 0, -1], useFixedBase=True)
 
@@ -332,19 +452,19 @@ class Env:
         #     self.create_voxel(halfExtents, basePosition)
 
         self.kukaId = p.loadURDF(self.simple_file, [0, 0, 0], [0, 0, 0, 1], useFixedBase=True,
-                                 flags=p.URDF_IGNORE_COLLISION_SHAPES)
+                                 flags=p.URDF_IGNORE_COLLISION_SHAPES, physicsClientId=self.client)
 
         self.set_config(path[0])
 
         target_kukaId = p.loadURDF(self.simple_file, [0, 0, 0], [0, 0, 0, 1], useFixedBase=True,
-                                   flags=p.URDF_IGNORE_COLLISION_SHAPES)
+                                   flags=p.URDF_IGNORE_COLLISION_SHAPES, physicsClientId=self.client)
         self.set_config(path[-1], target_kukaId)
 
-        prev_pos = p.getLinkState(self.kukaId, self.end_effector_index)[0]
-        final_pos = p.getLinkState(target_kukaId, self.end_effector_index)[0]
+        prev_pos = p.getLinkState(self.kukaId, self.end_effector_index, physicsClientId=self.client)[0]
+        final_pos = p.getLinkState(target_kukaId, self.end_effector_index, physicsClientId=self.client)[0]
 
-        p.setGravity(0, 0, -10)
-        p.stepSimulation()
+        p.setGravity(0, 0, -10, physicsClientId=self.client)
+        p.stepSimulation(physicsClientId=self.client)
 
         gifs = []
         current_state_idx = 0
@@ -356,30 +476,30 @@ class Env:
             d = self.distance(path[current_state_idx], path[current_state_idx + 1])
 
             new_arm = p.loadURDF(self.simple_file, [0, 0, 0], [0, 0, 0, 1], useFixedBase=True,
-                                  flags=p.URDF_IGNORE_COLLISION_SHAPES)
-            for data in p.getVisualShapeData(new_arm):
+                                  flags=p.URDF_IGNORE_COLLISION_SHAPES, physicsClientId=self.client)
+            for data in p.getVisualShapeData(new_arm, physicsClientId=self.client):
                 color = list(data[-1])
                 color[-1] = 0.5
-                p.changeVisualShape(new_arm, data[1], rgbaColor=color)
+                p.changeVisualShape(new_arm, data[1], rgbaColor=color, physicsClientId=self.client)
 
             K = int(np.ceil(d / 0.2))
             for k in range(0, K):
 
                 c = path[current_state_idx] + k * 1. / K * disp
                 self.set_config(c, new_arm)
-                new_pos = p.getLinkState(new_arm, self.end_effector_index)[0]
-                p.addUserDebugLine(prev_pos, new_pos, [1, 0, 0], 10, 0)
+                new_pos = p.getLinkState(new_arm, self.end_effector_index, physicsClientId=self.client)[0]
+                p.addUserDebugLine(prev_pos, new_pos, [1, 0, 0], 10, 0, physicsClientId=self.client)
                 prev_pos = new_pos
-                p.loadURDF("sphere2red.urdf", new_pos, globalScaling=0.05, flags=p.URDF_IGNORE_COLLISION_SHAPES)
+                p.loadURDF("sphere2red.urdf", new_pos, globalScaling=0.05, flags=p.URDF_IGNORE_COLLISION_SHAPES, physicsClientId=self.client)
                 if make_gif:
                     gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=self.client)[2])
 
             current_state_idx += 1
             if current_state_idx == len(path) - 1:
                 self.set_config(path[-1], new_arm)
-                p.addUserDebugLine(prev_pos, final_pos, [1, 0, 0], 10, 0)
-                p.loadURDF("sphere2red.urdf", final_pos, globalScaling=0.05, flags=p.URDF_IGNORE_COLLISION_SHAPES)
+                p.addUserDebugLine(prev_pos, final_pos, [1, 0, 0], 10, 0, physicsClientId=self.client)
+                p.loadURDF("sphere2red.urdf", final_pos, globalScaling=0.05, flags=p.URDF_IGNORE_COLLISION_SHAPES, physicsClientId=self.client)
                 break
 
         return gifs
\ No newline at end of file
@@ -5,8 +5,9 @@ import numpy as np
 import time
 import argparse
 import importlib
+import multiprocessing as mp
 
-from torch_geometric.data import Data
+from torch_geometric.data import Data, Batch
 from configs.config import set_random_seed
 from tqdm import tqdm as tqdm
 from torch_sparse import coalesce
@@ -15,9 +16,11 @@ from torch_geometric.nn import knn_graph
 from utils import make_gif
 
 from result import show_result
-from model import GNNet, TemporalEncoder, PolicyHead
+from model import GNNet, TemporalEncoder, PolicyHead, edge_csr
 from configs.config import set_random_seed, load_config
-from utils import load_dataset, to_np
+from utils import load_dataset, load_time_windows, to_np, KnnGraph, cache_obs_points, compute_obs_points, \
+    num_problems, can_load_lazily
+from dataset import read_record
 
 parser = argparse.ArgumentParser(description='GNN-Dynamic')
 parser.add_argument('--yaml_file', type=str, default='configs/2arms.yaml',
@@ -38,7 +41,11 @@ class Planner():
         #### Load files ####
         self.test_obs_file = cfg['data']['testing_files_obs']
         self.test_graph_file = cfg['data']['testing_files_graph']
-        self.graphs, self.obs_setting = load_dataset(self.test_graph_file, self.test_obs_file)
+        if cfg['data'].get('cache_obs_points', False):
+            cache_obs_points(self.env, self.test_obs_file)
+        self.graphs, self.obs_setting = load_dataset(self.test_graph_file, self.test_obs_file,
+                                                     lazy=cfg['data'].get('lazy_load', False),
+                                                     cache_size=cfg['data'].get('lazy_cache_size', 0))
         self.num_graphs = len(self.graphs)
 
         #### Load models ####
@@ -67,6 +74,12 @@ class Planner():
             self.search_type = 'vanilla'
             self.explore_func = self.explore_vanilla
         self.max_num_samples = cfg['test']['max_num_samples']
+        # number of problems sharing one global encoding forward pass
+        self.batch_size = cfg['test'].get('batch_size', 1)
+        # after a failed attempt only re-encode this many hops around the new samples, None: whole graph
+        self.incremental_hops = cfg['test'].get('incremental_hops', None)
+        # number of worker processes the test problems are sharded across
+        self.num_workers = cfg['test'].get('num_workers', 1)
 
     @staticmethod
     def create_data(points, edge_index=None, k=50):
@@ -91,7 +104,7 @@ class Planner():
         return data
 
     @torch.no_grad()
-    def explore_vanilla(self, graph_points, graph_edge_index, n_sample=200, t_max=2000, k=50, loop=5):
+    def explore_vanilla(self, graph_points, graph_edge_index, n_sample=200, t_max=2000, k=50, loop=5, encoding=None):
         c0 = self.env.collision_check_count
         success = False
         path = []
@@ -99,17 +112,38 @@ class Planner():
         ## Construct a graph ####
         points = graph_points
         data = self.create_data(points, edge_index=graph_edge_index, k=k)
+        knn = None
+        prev_encoding, node_map = None, None
+
+        ## per-problem obstacle tensors, shared by all attempts
+        x = torch.arange(len(self.env.obs_points))
+        pe = self.te_gnn(x).to(device)
+        obstacles = torch.FloatTensor(self.env.obs_points).to(device)
+        # obstacle window and its temporal encoding for every time tick
+        obs_tw, tmp_enc_tw = load_time_windows(self.env.obs_points, self.half_win_len, self.te_head, device)
 
         ######### Try multiple times ########
         while not success and (len(points) - 2) <= t_max:
 
-            x = torch.arange(len(self.env.obs_points))
-            pe = self.te_gnn(x).to(device)
-
-            edge_feat, node_feat = self.model_gnn(**data.to(device).to_dict(),
-                                                  pos_enc=pe,
-                                                  obstacles=torch.FloatTensor(self.env.obs_points).to(device),
-                                                  loop=loop)
+            # visited nodes are disabled instead of erasing their edges
+            disabled = torch.zeros(len(data.v), dtype=torch.bool, device=device)
+
+            if encoding is not None:
+                # first attempt encoded together with other problems, see encode_batch
+                rowptr, col, edge_feat = encoding
+                encoding = None
+            else:
+                # neighbor index of the current graph
+                csr = edge_csr(data.edge_index.to(device), len(data.v))
+                (rowptr, col, edge_feat), node_feat = self.model_gnn(**data.to(device).to_dict(),
+                                                                     pos_enc=pe,
+                                                                     obstacles=obstacles,
+                                                                     loop=loop, sparse=True, csr=csr,
+                                                                     prev=prev_encoding, node_map=node_map,
+                                                                     hops=self.incremental_hops,
+                                                                     keep_encoding=self.incremental_hops is not None)
+                prev_encoding = self.model_gnn.encoding
+            rowptr = rowptr.tolist()
 
             # explore using the head network
             cur_node = 0
@@ -124,20 +158,13 @@ class Planner():
             ######### explore the graph ########
             while success == False:
 
-                nonzero_indices = torch.where(edge_feat[cur_node, :, :] != 0)[0].unique()
-                if nonzero_indices.size()[0] == 0:
-                    print('hello')
-                edges = edge_feat[cur_node, nonzero_indices, :]
-
-                time_window = list(range(-self.half_win_len, self.half_win_len + 1))
-                offsets = torch.LongTensor(time_window)
-                time_window = torch.clip(int(time_tick) + offsets, 0, self.env.obs_points.shape[0] - 1)
-                obs = torch.FloatTensor(self.env.obs_points[time_window].flatten())[None, :].repeat(edges.shape[0],
-                                                                                                    1).to(
-                    device)
-                pos_enc_tw = self.te_head(time_window).flatten()[None, :].repeat(edges.shape[0], 1).to(device)
+                neighbors = col[rowptr[cur_node]:rowptr[cur_node + 1]]
+                enabled = ~disabled[neighbors]
+                nonzero_indices = neighbors[enabled]
+                edges = edge_feat[rowptr[cur_node]:rowptr[cur_node + 1]][enabled]
 
-                policy = self.model_head(edges, obs, pos_enc_tw).flatten()  # [N, 32*4]
+                tick = min(int(time_tick), len(obs_tw) - 1)
+                policy = self.model_head(edges, obs_tw[[tick]], tmp_enc_tw[[tick]]).flatten()  # [N, 32*4]
                 policy = policy.cpu()
 
                 ######### Take one step based on the policy ########
@@ -174,7 +201,7 @@ class Planner():
                             costs[next_node] = costs[cur_node] + dist
                             time_tick += int(np.ceil(dist / self.env.speed))
                             path.append((next_node, time_tick))
-                            edge_feat[:, cur_node, :] = 0
+                            disabled[cur_node] = True
                             stay_counter = 0
 
                         # update node
@@ -197,14 +224,13 @@ class Planner():
 
             if not success:
                 new_points = self.env.uniform_sample_mine(n_sample)
-                original_points = data.v.cpu()
-                points = torch.cat(
-                    (original_points[:-1, :], torch.FloatTensor(new_points), original_points[[-1], :]), dim=0)
+                # the neighbor lists are kept across attempts, only the new points are searched
+                if knn is None:
+                    knn = KnnGraph(data.v, k=k, device=device)
+                node_map = knn.insert(new_points)
+                points = knn.points.cpu()
                 data.v = points
-
-                edge_index = knn_graph(torch.FloatTensor(data.v), k=k, loop=True)
-                edge_index = torch.cat((edge_index, edge_index.flip(0)), dim=-1).to(device)
-                data.edge_index, _ = coalesce(edge_index, None, len(data.v), len(data.v))
+                data.edge_index = knn.edge_index()
 
                 # create labels
                 labels = torch.zeros(len(data.v), 1).to(device)
@@ -218,7 +244,7 @@ class Planner():
 
 
     @torch.no_grad()
-    def explore_backtrack(self, graph_points, graph_edge_index, n_sample=200, t_max=2000, k=50, loop=5):
+    def explore_backtrack(self, graph_points, graph_edge_index, n_sample=200, t_max=2000, k=50, loop=5, encoding=None):
         c0 = self.env.collision_check_count
         success = False
         path = []
@@ -226,18 +252,38 @@ class Planner():
         ## Construct a graph ####
         points = graph_points
         data = self.create_data(points, edge_index=graph_edge_index, k=k)
+        knn = None
+        prev_encoding, node_map = None, None
+
+        ## per-problem obstacle tensors, shared by all attempts
+        x = torch.arange(len(self.env.obs_points))
+        pe = self.te_gnn(x).to(device)
+        obstacles = torch.FloatTensor(self.env.obs_points).to(device)
+        # obstacle window and its temporal encoding for every time tick
+        obs_tw, tmp_enc_tw = load_time_windows(self.env.obs_points, self.half_win_len, self.te_head, device)
 
         ######### Try multiple times ########
         while not success and (len(points) - 2) <= t_max:
 
-            ## get positional encoding
-            x = torch.arange(len(self.env.obs_points))
-            pe = self.te_gnn(x).to(device)
-
-            edge_feat, node_feat = self.model_gnn(**data.to(device).to_dict(),
-                                                  pos_enc=pe,
-                                                  obstacles=torch.FloatTensor(self.env.obs_points).to(device),
-                                                  loop=loop)
+            # visited nodes are disabled instead of erasing their edges
+            disabled = torch.zeros(len(data.v), dtype=torch.bool, device=device)
+
+            if encoding is not None:
+                # first attempt encoded together with other problems, see encode_batch
+                rowptr, col, edge_feat = encoding
+                encoding = None
+            else:
+                # neighbor index of the current graph
+                csr = edge_csr(data.edge_index.to(device), len(data.v))
+                (rowptr, col, edge_feat), node_feat = self.model_gnn(**data.to(device).to_dict(),
+                                                                     pos_enc=pe,
+                                                                     obstacles=obstacles,
+                                                                     loop=loop, sparse=True, csr=csr,
+                                                                     prev=prev_encoding, node_map=node_map,
+                                                                     hops=self.incremental_hops,
+                                                                     keep_encoding=self.incremental_hops is not None)
+                prev_encoding = self.model_gnn.encoding
+            rowptr = rowptr.tolist()
 
             # explore using the head network
             cur_node = 0
@@ -257,17 +303,13 @@ class Planner():
             ######### explore the graph ########
             while success == False:
 
-                nonzero_indices = torch.where(edge_feat[cur_node, :, :] != 0)[0].unique()
-                edges = edge_feat[cur_node, nonzero_indices, :]
+                neighbors = col[rowptr[cur_node]:rowptr[cur_node + 1]]
+                enabled = ~disabled[neighbors]
+                nonzero_indices = neighbors[enabled]
+                edges = edge_feat[rowptr[cur_node]:rowptr[cur_node + 1]][enabled]
 
-                time_window = list(range(-self.half_win_len, self.half_win_len + 1))
-                offsets = torch.LongTensor(time_window)
-                time_window = torch.clip(int(time_tick) + offsets, 0, self.env.obs_points.shape[0] - 1)
-                obs = torch.FloatTensor(self.env.obs_points[time_window].flatten())[None, :].repeat(edges.shape[0], 1).to(
-                    device)
-                pos_enc_tw = self.te_head(time_window).flatten()[None, :].repeat(edges.shape[0], 1).to(device)
-
-                policy = self.model_head(edges, obs, pos_enc_tw).flatten()
+                tick = min(int(time_tick), len(obs_tw) - 1)
+                policy = self.model_head(edges, obs_tw[[tick]], tmp_enc_tw[[tick]]).flatten()
 
                 if back_tracking == False:
                     children = nonzero_indices[torch.argsort(policy, descending=True)].tolist()
@@ -280,45 +322,47 @@ class Planner():
 
                 success_one_step = False
 
-                while len(cur_stack) != 0:  # select non-collision edge with priority
-
-                    cur_node, next_node, time_tick = cur_stack.pop()
-
-                    if next_node == prev_node:
-                        continue
-
-                    ############ Take the step #########
-                    if self.env._edge_fp(to_np(data.v[cur_node]), to_np(data.v[next_node]), time_tick):
-                        # step forward
-                        success_one_step = True
-                        ## put the following k-1 children into the history stack
-                        history_stack.extend([cur_stack.pop() for _ in range(min(self.bt_buffer_size-1, len(cur_stack)))])
-                        ## end backtracking mode
-                        back_tracking = False
-
-                        dist = np.linalg.norm(to_np(data.v[next_node]) - to_np(data.v[cur_node]))
-                        if dist == 0:  # stay
-                            stay_counter += 1
-                            costs[next_node] = costs[cur_node] + self.env.speed
-                            old_time = time_tick
-                            time_tick += 1
-                            prevs[(next_node, time_tick)] = (cur_node, old_time)
+                # candidate edges in the order they are popped, checked in one call up to the first free one
+                pop_order = [i for i in reversed(range(len(cur_stack))) if cur_stack[i][1] != prev_node]
+                free = self.env.check_edges(to_np(data.v[[cur_stack[i][0] for i in pop_order]]),
+                                            to_np(data.v[[cur_stack[i][1] for i in pop_order]]),
+                                            [cur_stack[i][2] for i in pop_order], stop_at_free=True)
+
+                ############ Take the step #########
+                if free.any():
+                    # the entries popped up to the free edge are dropped, cur_stack may be the history stack
+                    i = pop_order[int(free.argmax())]
+                    cur_node, next_node, time_tick = cur_stack[i]
+                    del cur_stack[i:]
+
+                    # step forward
+                    success_one_step = True
+                    ## put the following k-1 children into the history stack
+                    history_stack.extend([cur_stack.pop() for _ in range(min(self.bt_buffer_size-1, len(cur_stack)))])
+                    ## end backtracking mode
+                    back_tracking = False
+
+                    dist = np.linalg.norm(to_np(data.v[next_node]) - to_np(data.v[cur_node]))
+                    if dist == 0:  # stay
+                        stay_counter += 1
+                        costs[next_node] = costs[cur_node] + self.env.speed
+                        old_time = time_tick
+                        time_tick += 1
+                        prevs[(next_node, time_tick)] = (cur_node, old_time)
 
-                        else:
-                            costs[next_node] = costs[cur_node] + dist
-                            old_time = time_tick
-                            time_tick += int(np.ceil(dist / self.env.speed))
-                            prevs[(next_node, time_tick)] = (cur_node, old_time)
-                            edge_feat[:, cur_node, :] = 0
-                            stay_counter = 0
-
-                        # update node
-                        prev_node = cur_node
-                        cur_node = next_node
-                        break
-                    ############ Search for another feasible edge #########
                     else:
-                        continue
+                        costs[next_node] = costs[cur_node] + dist
+                        old_time = time_tick
+                        time_tick += int(np.ceil(dist / self.env.speed))
+                        prevs[(next_node, time_tick)] = (cur_node, old_time)
+                        disabled[cur_node] = True
+                        stay_counter = 0
+
+                    # update node
+                    prev_node = cur_node
+                    cur_node = next_node
+                else:
+                    cur_stack.clear()
 
                 if success_one_step == False:
                     if len(history_stack) == 0:
@@ -345,14 +389,13 @@ class Planner():
 
             if not success:
                 new_points = self.env.uniform_sample_mine(n_sample)
-                original_points = data.v.cpu()
-                points = torch.cat(
-                    (original_points[:-1, :], torch.FloatTensor(new_points), original_points[[-1], :]), dim=0)
+                # the neighbor lists are kept across attempts, only the new points are searched
+                if knn is None:
+                    knn = KnnGraph(data.v, k=k, device=device)
+                node_map = knn.insert(new_points)
+                points = knn.points.cpu()
                 data.v = points
-
-                edge_index = knn_graph(torch.FloatTensor(data.v), k=k, loop=True)
-                edge_index = torch.cat((edge_index, edge_index.flip(0)), dim=-1).to(device)
-                data.edge_index, _ = coalesce(edge_index, None, len(data.v), len(data.v))
+                data.edge_index = knn.edge_index()
 
                 # create labels
                 labels = torch.zeros(len(data.v), 1).to(device)
@@ -365,8 +408,61 @@ class Planner():
         return path, success, check_collision, np.array(data.v.cpu())
 
 
-    def motion_planning(self, seed, indexes, use_tqdm=False, t_max=2000, k=50, **kwargs):
+    def load_problem(self, index):
+        self.env.init_new_problem(index=index, setting_dict=self.obs_setting)
+        record = read_record(self.graphs[index])
+        graph_points = record['points']
+        graph_edge_index = record['edge_index']
+        if record['half_extents'] is not None:
+            halfExtents_list = record['half_extents']
+            basePosition_list = record['base_positions']
+            for halfExtents, basePosition in zip(halfExtents_list, basePosition_list):
+                self.env.create_voxel(halfExtents, basePosition)
+        return graph_points, graph_edge_index
 
+    @torch.no_grad()
+    def encode_batch(self, indexes, k=50, loop=5):
+        """
+        Global encoding of several problems in one GNNet forward over the disjoint union of their graphs.
+        Returns the CSR edge features (rowptr, col, edge_feat) of every problem in the order of indexes.
+        """
+        # only the records and obstacle points are needed, the scenes are loaded by motion_planning
+        if 'obs_points' in self.obs_setting:
+            obs_points = [self.obs_setting['obs_points'][index] for index in indexes]
+        else:
+            obs_points = compute_obs_points(self.env, self.obs_setting, indexes)
+
+        data_list = []
+        for index, problem_obs_points in zip(indexes, obs_points):
+            record = read_record(self.graphs[index])
+            data = self.create_data(record['points'], edge_index=record['edge_index'], k=k)
+            data.edge_index = data.edge_index.cpu()
+            data.num_nodes = len(data.v)
+            data.obstacles = torch.FloatTensor(problem_obs_points)[None, :, :]
+            data_list.append(data)
+        batch = Batch.from_data_list(data_list).to(device)
+
+        x = torch.arange(batch.obstacles.shape[1])
+        pe = self.te_gnn(x).to(device)
+
+        csr = edge_csr(batch.edge_index, len(batch.v))
+        (rowptr, col, edge_feat), node_feat = self.model_gnn(**batch.to_dict(), pos_enc=pe, loop=loop,
+                                                             sparse=True, csr=csr)
+
+        # graphs are contiguous node ranges of the batch, so are their CSR rows
+        encodings = []
+        ptr = batch.ptr.tolist()
+        for i in range(len(data_list)):
+            n0, n1 = ptr[i], ptr[i + 1]
+            e0, e1 = int(rowptr[n0]), int(rowptr[n1])
+            encodings.append((rowptr[n0:n1 + 1] - e0, col[e0:e1] - n0, edge_feat[e0:e1]))
+        return encodings
+
+    def motion_planning(self, seed, indexes, use_tqdm=False, t_max=2000, k=50, batch_size=1, **kwargs):
+        """
+        Every problem is planned with the random seed seed + index, so results do not depend on
+        how the problems are batched or sharded across workers.
+        """
         set_random_seed(seed)
         self.model_gnn.eval()
         self.model_head.eval()
@@ -374,39 +470,93 @@ class Planner():
         result_dict = {'success': [], 'path_time': [], 'path': [], 'check_collision': [], 'points': [],
                        'inference_time': []}
 
-        pbar = tqdm(indexes) if use_tqdm else indexes
-        for index in pbar:
-            self.env.init_new_problem(index=index, setting_dict=self.obs_setting)
-            graph_points = self.graphs[index][0]
-            graph_edge_index = self.graphs[index][1]
-            if len(self.graphs[index]) == 11:
-                halfExtents_list = self.graphs[index][2]
-                basePosition_list = self.graphs[index][3]
-                for halfExtents, basePosition in zip(halfExtents_list, basePosition_list):
-                    self.env.create_voxel(halfExtents, basePosition)
-
-            t0 = time.time()
-            result = self.explore_func(graph_points, graph_edge_index, t_max=t_max, k=k)
-
-            result_dict['inference_time'].append(time.time() - t0)
-
-            path, success, check_collision, points = result
-            result_dict['points'].append(points)
-            result_dict['success'].append(success)
-            result_dict['path'].append(path)
-            result_dict['path_time'].append(path[-1][-1])
-            result_dict['check_collision'].append(check_collision)
+        indexes = list(indexes)
+        chunks = [indexes[i:i + batch_size] for i in range(0, len(indexes), batch_size)]
+        pbar = tqdm(total=len(indexes)) if use_tqdm else None
+        for chunk in chunks:
+            encodings = [None] * len(chunk)
+            encode_time = 0.
+            if batch_size > 1:
+                t0 = time.time()
+                encodings = self.encode_batch(chunk, k=k)
+                encode_time = (time.time() - t0) / len(chunk)
+
+            for index, encoding in zip(chunk, encodings):
+                graph_points, graph_edge_index = self.load_problem(index)
+                set_random_seed(seed + index)
+
+                t0 = time.time()
+                result = self.explore_func(graph_points, graph_edge_index, t_max=t_max, k=k, encoding=encoding)
+
+                result_dict['inference_time'].append(time.time() - t0 + encode_time)
+
+                path, success, check_collision, points = result
+                result_dict['points'].append(points)
+                result_dict['success'].append(success)
+                result_dict['path'].append(path)
+                result_dict['path_time'].append(path[-1][-1])
+                result_dict['check_collision'].append(check_collision)
+
+                if pbar is not None:
+                    pbar.update(1)
 
         return result_dict
 
 
+def eval_worker(pid, cfg, indexes, seed, num_workers, **kwargs):
+    """
+    Run Planner.motion_planning on a shard of the test problems in its own process,
+    with its own pybullet client and copy of the models.
+    """
+    torch.set_num_threads(max(1, mp.cpu_count() // num_workers))
+    # a worker only reads the records of its shard when the dataset allows it
+    if can_load_lazily(cfg['data']['testing_files_graph']):
+        cfg = dict(cfg, data=dict(cfg['data'], lazy_load=True))
+    planner = Planner(cfg)
+    t0 = time.time()
+    result_dict = planner.motion_planning(seed=seed, indexes=indexes, **kwargs)
+    elapsed = time.time() - t0
+    print(f'worker {pid}: {len(indexes)} problems in {elapsed:.1f}s, {len(indexes) / elapsed:.2f} problems/s')
+    return result_dict
+
+
+def parallel_motion_planning(cfg, seed, indexes, num_workers, **kwargs):
+    """
+    Planner.motion_planning with the indexes sharded across num_workers processes,
+    the results are merged in the order of indexes.
+    """
+    shards = [shard.tolist() for shard in np.array_split(np.array(list(indexes)), num_workers) if len(shard)]
+    # spawn, a forked CUDA context or pybullet connection can not be used in the workers
+    with mp.get_context('spawn').Pool(processes=len(shards)) as pool:
+        results = [pool.apply_async(eval_worker, args=(pid, cfg, shard, seed, len(shards)), kwds=kwargs)
+                   for pid, shard in enumerate(shards)]
+        results = [r.get() for r in results]
+
+    result_dict = {key: [] for key in results[0]}
+    for worker_result in results:
+        for key in result_dict:
+            result_dict[key].extend(worker_result[key])
+    return result_dict
+
+
 if __name__ == '__main__':
     cfg = load_config(args.yaml_file)
     model_name = 'arm2'
 
-    planner = Planner(cfg)
-    indexes = range(planner.num_graphs)
-
-    result_dict = planner.motion_planning(seed=1234, indexes=indexes, use_tqdm=True, t_max=planner.max_num_samples)
-    show_result(model_name=model_name, gt_file=planner.test_graph_file, result_dict=result_dict, index_list=indexes)
-    np.savez(f'result/{model_name}_{planner.search_type}.npz', **result_dict)
+    test_graph_file = cfg['data']['testing_files_graph']
+    search_type = 'backtrack' if cfg['test']['backtracking'] else 'vanilla'
+    num_workers = cfg['test'].get('num_workers', 1)
+    batch_size = cfg['test'].get('batch_size', 1)
+
+    if num_workers > 1:
+        # the workers load the models and the dataset themselves
+        indexes = range(num_problems(test_graph_file, cfg['data']['testing_files_obs']))
+        result_dict = parallel_motion_planning(cfg, seed=1234, indexes=indexes, num_workers=num_workers,
+                                               t_max=cfg['test']['max_num_samples'], batch_size=batch_size)
+    else:
+        planner = Planner(cfg)
+        indexes = range(planner.num_graphs)
+        result_dict = planner.motion_planning(seed=1234, indexes=indexes, use_tqdm=True, t_max=planner.max_num_samples,
+                                              batch_size=batch_size)
+    show_result(model_name=model_name, gt_file=test_graph_file, result_dict=result_dict, index_list=indexes)
+    np.savez(f'result/{model_name}_{search_type}.npz', **result_dict)
@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 from torch import nn
+import torch.nn.functional as F
 from torch.nn import Sequential as Seq, Linear as Lin, ReLU
 from torch_geometric.nn.conv import MessagePassing
 
@@ -64,40 +65,157 @@ class GNNet(torch.nn.Module):
         self.edge_feature.reset_parameters()
 
 
-    def forward(self, v, labels, obstacles, pos_enc, edge_index, loop, **kwargs):
+    def forward(self, v, labels, obstacles, pos_enc, edge_index, loop, sparse=False, csr=None, batch=None,
+                prev=None, node_map=None, hops=None, keep_encoding=False, **kwargs):
+        """
+        sparse=False: edge_feat is a dense [N, N, embed_size] tensor
+        sparse=True:  edge_feat is a CSR triple (rowptr, col, y), y[rowptr[i]:rowptr[i+1]] are the
+                      features of the edges leaving node i towards col[rowptr[i]:rowptr[i+1]]
+        csr: (rowptr, col, perm) from edge_csr(edge_index), reused instead of being rebuilt
+        batch: graph id of every node when v is a disjoint union of K graphs (PyG Batch),
+               obstacles is then [K, T, obs_size] and every graph has its own goal
+        prev, node_map, hops: incremental re-encoding of a grown graph, see incremental_encoding
+        keep_encoding: keep the encoding of this call in self.encoding, the prev of a later re-encoding
+        """
 
         self.labels = labels
         # labels: ?goal, one-hot
         v = torch.cat((v, labels), dim=-1)
-        goal = v[labels[:, 0] == 1].view(1, -1)
-        x = self.hx(torch.cat((v, goal.repeat(len(v), 1), v - goal, (v - goal) ** 2), dim=-1))  # node
-
-        vi, vj = v[edge_index[0, :]], v[edge_index[1, :]]
-        y = self.hy(torch.cat((vj - vi, vj, vi), dim=-1))  # edge
+        if batch is None:
+            goal = v[labels[:, 0] == 1].view(1, -1).repeat(len(v), 1)
+        else:
+            goal = v[labels[:, 0] == 1][batch]
 
+        obs_node_code, obs_edge_code, edge_batch = None, None, None
         if self.use_obstacles:
+            if batch is None:
+                obstacles = obstacles.view(-1, self.obs_size)
+            else:
+                obstacles = obstacles.view(obstacles.shape[0], -1, self.obs_size)
+                edge_batch = batch[edge_index[0, :]]
 
-            obs_node_code = self.obs_node_code(obstacles.view(-1, self.obs_size))
+            obs_node_code = self.obs_node_code(obstacles)
             obs_node_code = obs_node_code + pos_enc
 
-            obs_edge_code = self.obs_edge_code(obstacles.view(-1, self.obs_size))
+            obs_edge_code = self.obs_edge_code(obstacles)
             obs_edge_code = obs_edge_code + pos_enc
 
-            for na, ea in zip(self.node_attentions, self.edge_attentions):
-                x = na(x, obs_node_code)
-                y = ea(y, obs_edge_code)
-
-        # message passing loops
-        for _ in range(loop):
-            x = self.mpnn(x, edge_index, y)
-            xi, xj = x[edge_index[0, :]], x[edge_index[1, :]]
-            y = torch.max(y, self.fy(torch.cat((xj - xi, xj, xi), dim=-1)))
+        if prev is not None and hops is not None and batch is None:
+            x0, y0, x, y = self.incremental_encoding(v, goal, obs_node_code, obs_edge_code, edge_index, loop,
+                                                     prev, node_map, hops)
+        else:
+            x0 = self.encode_nodes(v, goal, obs_node_code, batch)
+            y0 = self.encode_edges(v, edge_index, obs_edge_code, edge_batch)
+
+            # message passing loops
+            x, y = x0, y0
+            for _ in range(loop):
+                x = self.mpnn(x, edge_index, y)
+                xi, xj = x[edge_index[0, :]], x[edge_index[1, :]]
+                y = torch.max(y, self.fy(torch.cat((xj - xi, xj, xi), dim=-1)))
+
+        # kept for an incremental re-encoding of this graph
+        self.encoding = None
+        if keep_encoding:
+            self.encoding = {'edge_index': edge_index, 'x0': x0.detach(), 'y0': y0.detach(),
+                             'x': x.detach(), 'y': y.detach()}
+
+        if sparse:
+            rowptr, col, perm = csr if csr is not None else edge_csr(edge_index, len(v))
+            return (rowptr, col, y[perm]), x
 
         edge_feat = y.new_zeros(len(v), len(v), self.embed_size)
         edge_feat[edge_index[0, :], edge_index[1, :]] = y
 
         return edge_feat, x
 
+    def encode_nodes(self, v, goal, obs_node_code, batch=None):
+        # every node is encoded independently of the others
+        x = self.hx(torch.cat((v, goal, v - goal, (v - goal) ** 2), dim=-1))  # node
+        if self.use_obstacles:
+            for na in self.node_attentions:
+                x = na(x, obs_node_code, batch)
+        return x
+
+    def encode_edges(self, v, edge_index, obs_edge_code, edge_batch=None):
+        # every edge is encoded independently of the others
+        vi, vj = v[edge_index[0, :]], v[edge_index[1, :]]
+        y = self.hy(torch.cat((vj - vi, vj, vi), dim=-1))  # edge
+        if self.use_obstacles:
+            for ea in self.edge_attentions:
+                y = ea(y, obs_edge_code, edge_batch)
+        return y
+
+    def incremental_encoding(self, v, goal, obs_node_code, obs_edge_code, edge_index, loop, prev, node_map, hops):
+        """
+        Re-encode a graph that grew from the graph of a previous forward (prev = self.encoding of that call).
+        node_map: index of every previous node in the current graph.
+        Node/edge encodings of unchanged nodes/edges are reused, message passing is only rerun for
+        the nodes within `hops` hops of the added points and of the added/removed edges, the other nodes
+        and edges keep their previous outputs. Larger hops is more accurate, hops >= loop changes
+        only nodes near the border of that region.
+        """
+        num_nodes = len(v)
+
+        # nodes: reuse the encodings of previous nodes, encode the new ones
+        is_new = torch.ones(num_nodes, dtype=torch.bool, device=v.device)
+        is_new[node_map] = False
+        x0 = v.new_empty(num_nodes, self.embed_size)
+        x0[node_map] = prev['x0']
+        x0[is_new] = self.encode_nodes(v[is_new], goal[is_new], obs_node_code)
+        x = v.new_empty(num_nodes, self.embed_size)
+        x[node_map] = prev['x']
+
+        # edges: match the previous edges by (source, target) in the current numbering
+        prev_edge_index = node_map[prev['edge_index']]
+        key = edge_index[0, :] * num_nodes + edge_index[1, :]
+        prev_key = prev_edge_index[0, :] * num_nodes + prev_edge_index[1, :]
+        prev_key_sorted, order = prev_key.sort()
+        pos = torch.searchsorted(prev_key_sorted, key).clamp(max=len(prev_key) - 1)
+        matched = prev_key_sorted[pos] == key
+        prev_pos = order[pos[matched]]
+
+        y0 = v.new_empty(len(key), self.embed_size)
+        y0[matched] = prev['y0'][prev_pos]
+        y0[~matched] = self.encode_edges(v, edge_index[:, ~matched], obs_edge_code)
+        y = v.new_empty(len(key), self.embed_size)
+        y[matched] = prev['y'][prev_pos]
+
+        # region to recompute: new nodes and the end points of added and removed edges, grown by hops
+        region = is_new.clone()
+        region[edge_index[:, ~matched].flatten()] = True
+        region[prev_edge_index[:, ~torch.isin(prev_key, key)].flatten()] = True
+        for _ in range(hops):
+            region = region.clone()
+            region[edge_index[0, region[edge_index[1, :]]]] = True
+
+        # message passing restricted to the edges touching the region
+        x[region] = x0[region]
+        sub = region[edge_index[0, :]] | region[edge_index[1, :]]
+        sub_edge_index = edge_index[:, sub]
+        incoming = region[sub_edge_index[1, :]]
+        y_sub = y0[sub]
+        for _ in range(loop):
+            out = self.mpnn(x, sub_edge_index[:, incoming], y_sub[incoming])
+            x = torch.where(region[:, None], out, x)
+            xi, xj = x[sub_edge_index[0, :]], x[sub_edge_index[1, :]]
+            y_sub = torch.max(y_sub, self.fy(torch.cat((xj - xi, xj, xi), dim=-1)))
+        y[sub] = y_sub
+
+        return x0, y0, x, y
+
+
+def edge_csr(edge_index, num_nodes):
+    """
+    CSR view of edge_index: the neighbors of node i are col[rowptr[i]:rowptr[i+1]],
+    perm maps CSR positions back to columns of edge_index
+    """
+    row = edge_index[0, :]
+    perm = torch.argsort(row * num_nodes + edge_index[1, :])
+    rowptr = row.new_zeros(num_nodes + 1)
+    rowptr[1:] = torch.cumsum(torch.bincount(row, minlength=num_nodes), dim=0)
+    return rowptr, edge_index[1, perm], perm
+
 
 class PolicyHead(torch.nn.Module):
     def __init__(self, embed_size, obs_size=9):
@@ -109,9 +227,21 @@ class PolicyHead(torch.nn.Module):
         self.layer2 = Seq(Lin(embed_size, embed_size), ReLU(),
                           Lin(embed_size, 1, bias=False))
 
-    def forward(self, edge_feat, obs, pe):
+    def forward(self, edge_feat, obs, pe, index=None):
+        """
+        obs, pe: either one row per edge, a single row shared by all edges,
+                 or one row per group of edges with index giving the group of every edge
+        """
         obs_code = obs + pe
-        policy = self.layer1(torch.concat([edge_feat, obs_code], dim=-1))
+        # first layer applied to the concatenation [edge_feat, obs_code] without materializing it,
+        # so the obstacle part is computed once per row of obs and broadcast over the edges
+        lin = self.layer1[0]
+        embed_size = edge_feat.shape[-1]
+        obs_code = F.linear(obs_code, lin.weight[:, embed_size:], lin.bias)
+        if index is not None:
+            obs_code = obs_code[index]
+        policy = F.linear(edge_feat, lin.weight[:, :embed_size]) + obs_code
+        policy = self.layer1[1:](policy)
         policy = self.layer2(policy)
         return policy
 
@@ -128,7 +258,11 @@ class Attention(torch.nn.Module):
         self.value = Lin(embed_size, embed_size, bias=False)
         self.layer_norm = torch.nn.LayerNorm(embed_size, eps=1e-6)
 
-    def forward(self, v_code, obs_code):
+    def forward(self, v_code, obs_code, batch=None):
+        """
+        batch=None: obs_code is [T, embed_size] and shared by every row of v_code
+        otherwise:  obs_code is [K, T, embed_size] and row i attends to obs_code[batch[i]]
+        """
         v_value = self.value(v_code)
         obs_value = self.value(obs_code)
 
@@ -137,14 +271,18 @@ class Attention(torch.nn.Module):
         v_key = self.key(v_code)
         obs_key = self.key(obs_code)
 
-        obs_attention = (v_query @ obs_key.T)
+        if batch is None:
+            obs_attention = (v_query @ obs_key.T)
+            obs_value = obs_value.unsqueeze(0).repeat(len(v_code), 1, 1)
+        else:
+            obs_value = obs_value[batch]
+            obs_attention = (v_query.unsqueeze(1) * obs_key[batch]).sum(dim=-1)
         self_attention = (v_query.reshape(-1) * v_key.reshape(-1)).reshape(-1, self.embed_size).sum(dim=-1)
         whole_attention = torch.cat((self_attention.unsqueeze(-1), obs_attention), dim=-1)
         whole_attention = (whole_attention / self.temperature).softmax(dim=-1)
 
         v_code_new = (whole_attention.unsqueeze(-1) *
-                        torch.cat((v_value.unsqueeze(1), obs_value.unsqueeze(0).repeat(len(v_code), 1, 1)),
-                                  dim=1)).sum(dim=1)
+                        torch.cat((v_value.unsqueeze(1), obs_value), dim=1)).sum(dim=1)
 
         return self.layer_norm(v_code_new + v_code)
 
@@ -171,8 +309,8 @@ class Block(torch.nn.Module):
         self.attention = Attention(embed_size, embed_size ** 0.5)
         self.v_feed = FeedForward(embed_size, embed_size)
 
-    def forward(self, v_code, obs_code):
-        v_code = self.attention(v_code, obs_code)
+    def forward(self, v_code, obs_code, batch=None):
+        v_code = self.attention(v_code, obs_code, batch)
         v_code = self.v_feed(v_code)
 
         return v_code
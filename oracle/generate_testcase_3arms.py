@@ -1,12 +1,14 @@
 import time
 import argparse
+import os
 
 from tqdm import tqdm
-import pickle
 import pybullet as p
 import numpy as np
 from configs.config import load_config
 from sipp import SIPP, construct_graph
+from dataset import make_record
+from shards import ShardWriter, open_manifest, schedule, merge_shards
 
 parser = argparse.ArgumentParser(description='GNN-Dynamic')
 parser.add_argument('--yaml_file', type=str, default='configs/3arms.yaml',
@@ -17,6 +19,11 @@ cfg = load_config(args.yaml_file)
 valid_list_file_path = f"testcase/{cfg['env']['env_name']}/feasible_list.npy"
 graph_file_path = cfg['data']['training_files_graph'][0]
 obs_file_path = cfg['data']['training_files_obs'][0]
+# per-worker shards the cases are streamed to, merged into the files above at the end
+shard_dir = f"testcase/{cfg['env']['env_name']}/shards"
+# the SIPP search state is large and not used for training, only kept for debugging;
+# the search only runs to exhaustion when it is kept
+keep_sipp_state = cfg['data'].get('keep_sipp_state', False)
 
 
 class CaseGenerator():
@@ -132,22 +139,22 @@ class CaseGenerator():
                 self.env.set_config_obs(self.obs_traj[0])
 
                 if not self.env.check_collision_body(body_id) or not self.env.check_collision():
-                    p.removeBody(body_id)
+                    self.env.remove_voxel(body_id)
                     count += 1
                     continue
 
                 self.env.set_config_mine(self.mine_goal)
                 if not self.env.check_collision_body(body_id) or not self.env.check_collision():
-                    p.removeBody(body_id)
+                    self.env.remove_voxel(body_id)
                     count += 1
                     continue
 
                 if not self.env.check_traj_collision_body(self.obs_traj, body_id):
-                    p.removeBody(body_id)
+                    self.env.remove_voxel(body_id)
                     count += 1
                     continue
                 else:
-                    p.removeBody(body_id)
+                    self.env.remove_voxel(body_id)
                     break
 
             self.env.create_voxel(halfExtents, basePosition)
@@ -186,7 +193,7 @@ class CaseGenerator():
 
         edges, edge_cost, edge_index = construct_graph(points)
         t0 = time.time()
-        output = self.alg.path_planning(obs_traj, points, edges, edge_cost)
+        output = self.alg.path_planning(obs_traj, points, edges, edge_cost, exhaustive=keep_sipp_state)
         plan_time = time.time()-t0
         if output[0] == False:
             return False
@@ -199,49 +206,53 @@ class CaseGenerator():
 
 
 
-def main(pid, input_epochs):
-    obs_pos = []
-    obs_ori = []
-    obs_traj = []
-    data = []
-    init_states = []
-    goal_states = []
+def init_worker(lock):
+    global shard
+    tqdm.set_lock(lock)
+    # one shard per worker process, the chunks it runs all go to the same file
+    shard = ShardWriter(shard_dir, os.getpid())
 
-    low = input_epochs[0]
-    high = input_epochs[1]
-    tqdm_text = "#" + "{}".format(pid).zfill(3)
-    epochs = range(low, high)
 
-    feasible_list = []
+def main(problem_indexes):
+    """
+    Generate the cases of a chunk of problems, each seeded with its problem_index.
+    Returns (worker pid, number of problems, number of feasible cases, seconds spent).
+    """
+    start_time = time.time()
+    num_feasible = 0
 
-    with tqdm(total=high-low, desc=tqdm_text, position=pid + 1) as pbar:
-        for problem_index in epochs:
-
-            np.random.seed(problem_index)
-            gen = CaseGenerator(cfg, SIPP, n_points=1000)
+    for problem_index in problem_indexes:
+        np.random.seed(problem_index)
+        gen = CaseGenerator(cfg, SIPP, n_points=1000)
+        # the pybullet connection of the env is released on every path, also when a case fails
+        try:
             output = gen.algorithm()
 
             if output == False:
                 print(f'{problem_index} infeasible')
+                shard.write(problem_index)
                 continue
             else:
                 points, neighbors, edge_cost, edge_index, halfExtents_list, basePosition_list, arr_time, prev, safe_intervals, path, plan_time, end_time, collision_check = output
                 print(f'{problem_index} success:', collision_check)
 
-            feasible_list.append(problem_index)
-
-            obs_pos.append(gen.obs_pos)
-            obs_ori.append(gen.obs_ori)
-            obs_traj.append(gen.obs_traj)
-            init_states.append(points[0])
-            goal_states.append(points[len(points)-1])
-
-            data.append((points, edge_index, halfExtents_list, basePosition_list, arr_time, prev, safe_intervals, path, plan_time, end_time, collision_check))
+            obs = {'obs_pos': gen.obs_pos,
+                   'obs_ori': gen.obs_ori,
+                   'obs_traj': gen.obs_traj,
+                   'obs_points': gen.env.get_obs_points(gen.obs_traj),
+                   'init_states': points[0],
+                   'goal_states': points[len(points) - 1]
+                   }
 
+            sipp_state = (arr_time, prev, safe_intervals) if keep_sipp_state else None
+            record = make_record(points, edge_index, path, True, end_time, collision_check, halfExtents_list,
+                                 basePosition_list, plan_time, sipp_state)
+            shard.write(problem_index, record, obs)
+            num_feasible += 1
+        finally:
+            gen.env.close()
 
-            pbar.update(1)
-
-    return data, obs_pos, obs_ori, obs_traj, init_states, goal_states, feasible_list
+    return os.getpid(), len(problem_indexes), num_feasible, time.time() - start_time
 
 
 
@@ -253,54 +264,22 @@ if __name__ == '__main__':
     num_cores = int(mp.cpu_count())
     print("# cores: " + str(num_cores))
 
-    param_list = []
     total_num_testcases = 100
-    each_num = total_num_testcases // num_cores
-
-    start = 0
-    for i in range(num_cores):
-        param_list.append((start, start + each_num))
-        start += each_num
 
+    # a stopped run with the same settings resumes, the problems already in the shards are skipped
+    done = open_manifest(shard_dir, {'yaml_file': args.yaml_file, 'total_num_testcases': total_num_testcases})
 
+    with mp.Pool(processes=num_cores, initializer=init_worker, initargs=(tqdm.get_lock(),)) as pool:
+        schedule(pool, main, total_num_testcases, done, num_cores)
 
-    with mp.Pool(processes=num_cores, initializer=tqdm.set_lock, initargs=(tqdm.get_lock(),)) as pool:
-        results = [pool.apply_async(main, args=(i, epoch,)) for i, epoch in enumerate(param_list)]
-        results = [p.get() for p in results]
-
-    print("\n" * (len(param_list) + 1))
     print('finish all sipp')
 
-    data = []
-    obs_pos_all = []
-    obs_ori_all = []
-    obs_traj_all = []
-    init_states_all = []
-    goal_states_all = []
-    feasible_list = []
-    for i in range(len(results)):
-        data.extend(results[i][0])
-        obs_pos_all.extend(results[i][1])
-        obs_ori_all.extend(results[i][2])
-        obs_traj_all.extend(results[i][3])
-        init_states_all.extend(results[i][4])
-        goal_states_all.extend(results[i][5])
-        feasible_list.extend(results[i][6])
+    # whole chunks may overshoot the count, only the first feasible cases by problem_index are kept
+    obs_setting, feasible_list = merge_shards(shard_dir, graph_file_path, total_num_testcases)
 
     np.save(valid_list_file_path, feasible_list)
     print(len(feasible_list))
 
-    with open(graph_file_path, 'wb') as f:
-        pickle.dump(data, f, pickle.DEFAULT_PROTOCOL)
-
-    a = {'obs_pos': obs_pos_all,
-         'obs_ori': obs_ori_all,
-         'obs_traj': obs_traj_all,
-         'init_states': init_states_all,
-         'goal_states': goal_states_all
-         }
-    np.savez(obs_file_path, **a)
-
-    print(f'********* Saving {total_num_testcases} test files ************')
-
+    np.savez(obs_file_path, **obs_setting)
 
+    print(f'********* Saving {len(feasible_list)} test files ************')
@@ -0,0 +1,191 @@
+"""
+Streaming storage of generated test cases.
+
+Every worker appends its finished cases to its own shard file, one pickle per case, so that a stopped run
+loses at most the case in progress and memory does not grow with the dataset. A manifest in the shard
+directory records the settings of the run, a run with the same settings resumes from the shards.
+The problems are handed out to the workers in small chunks (schedule), so that no worker idles while
+others still have a long list of expensive problems.
+"""
+import glob
+import json
+import math
+import os
+import pickle
+import time
+
+from tqdm import tqdm
+
+from dataset import write_records
+
+MANIFEST = 'manifest.json'
+OBS_KEYS = ['obs_pos', 'obs_ori', 'obs_traj', 'obs_points', 'init_states', 'goal_states']
+
+
+def shard_paths(shard_dir):
+    return sorted(glob.glob(os.path.join(shard_dir, 'shard_*.pkl')))
+
+
+def iter_shard(path):
+    """
+    (end offset, problem_index, record, obs) of every complete case of a shard file,
+    a case cut off by a stopped run ends the shard
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                problem_index, record, obs = pickle.load(f)
+            except Exception:
+                return
+            yield f.tell(), problem_index, record, obs
+
+
+class ShardWriter():
+    """
+    Appends the cases of one worker to its shard file as they finish.
+    """
+    def __init__(self, shard_dir, shard_id):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.path = os.path.join(shard_dir, f'shard_{shard_id}.pkl')
+
+        # drop a case cut off by a stopped run so that new cases follow the last complete one
+        if os.path.exists(self.path):
+            end = 0
+            for end, _, _, _ in iter_shard(self.path):
+                pass
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+        self.file = open(self.path, 'ab')
+
+    def write(self, problem_index, record=None, obs=None):
+        """
+        record None marks an infeasible problem, it is skipped on resume as well
+        """
+        pickle.dump((problem_index, record, obs), self.file, pickle.DEFAULT_PROTOCOL)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_manifest(shard_dir, settings):
+    """
+    Start the shards of a run in shard_dir, or resume them when the manifest has the same settings.
+    Returns {problem_index: feasible} of the problems already done.
+    """
+    path = os.path.join(shard_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['settings'] != settings:
+            raise RuntimeError(f'Error: {shard_dir} holds the shards of another run {manifest["settings"]}')
+        done = {problem_index: record is not None
+                for shard in shard_paths(shard_dir) for _, problem_index, record, _ in iter_shard(shard)}
+        print(f'resume from {shard_dir}: {len(done)} problems done')
+        return done
+
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'settings': settings}, f)
+    return {}
+
+
+def schedule(pool, generate, total_num_cases, done, num_workers, chunk_size=4, max_num_problems=None, patience=100):
+    """
+    Run generate over chunks of problem indexes with pool.imap_unordered until total_num_cases feasible cases exist.
+    generate(chunk): (worker pid, number of problems, number of feasible cases, seconds spent) of a chunk
+    done: {problem_index: feasible} of the problems already in the shards, they are not handed out again
+    max_num_problems: problem indexes handed out at most, 10 * total_num_cases by default
+    patience: a round of at least this many problems without any feasible case stops the run
+    Returns the number of feasible cases.
+    """
+    if max_num_problems is None:
+        max_num_problems = 10 * total_num_cases
+    num_problems = len(done)
+    num_feasible = sum(done.values())
+
+    next_index = 0
+    worker_stats = {}
+    start_time = time.time()
+    with tqdm(total=total_num_cases, initial=min(num_feasible, total_num_cases)) as pbar:
+        while num_feasible < total_num_cases and next_index < max_num_problems:
+            # enough problems for the missing cases at the feasible rate so far, at least a chunk per worker
+            feasible_rate = num_feasible / num_problems if num_feasible else 0.5
+            num_todo = max(math.ceil((total_num_cases - num_feasible) / feasible_rate), num_workers * chunk_size)
+
+            todo = []
+            while len(todo) < num_todo and next_index < max_num_problems:
+                if next_index not in done:
+                    todo.append(next_index)
+                next_index += 1
+            chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+
+            round_feasible = 0
+            for pid, chunk_problems, chunk_feasible, elapsed in pool.imap_unordered(generate, chunks):
+                stats = worker_stats.setdefault(pid, [0, 0, 0.])
+                stats[0] += chunk_problems
+                stats[1] += chunk_feasible
+                stats[2] += elapsed
+                num_problems += chunk_problems
+                num_feasible += chunk_feasible
+                round_feasible += chunk_feasible
+                pbar.update(max(min(num_feasible, total_num_cases) - pbar.n, 0))
+
+            # the config or environment is broken when a large round yields nothing
+            if round_feasible == 0 and len(todo) >= patience:
+                print(f'\nno feasible case in a round of {len(todo)} problems, stop')
+                break
+
+    elapsed = time.time() - start_time
+    for pid, (worker_problems, worker_feasible, busy) in sorted(worker_stats.items()):
+        print(f'worker {pid}: {worker_problems} problems, {worker_feasible} feasible, '
+              f'{worker_problems / max(busy, 1e-9):.3f} problems/s, busy {busy / max(elapsed, 1e-9):.0%}')
+    if num_feasible < total_num_cases:
+        print(f'only {num_feasible} of {total_num_cases} feasible cases in {next_index} problems')
+    return num_feasible
+
+
+def merge_shards(shard_dir, graph_file_path, num_cases=None):
+    """
+    Write the feasible cases of all shards ordered by problem_index, the first num_cases of them when given,
+    to graph_file_path as a record stream. Records are streamed from the shards one at a time,
+    only the obstacle settings are collected.
+    Returns the obstacle settings {key: [value of every case]} and the problem indexes.
+    """
+    # shard and byte offset of every feasible case, a case generated again on resume replaces the earlier one
+    cases = {}
+    for shard in shard_paths(shard_dir):
+        start = 0
+        for end, problem_index, record, _ in iter_shard(shard):
+            if record is not None:
+                cases[problem_index] = (shard, start)
+            start = end
+
+    feasible_list = sorted(cases)[:num_cases]
+    obs_setting = {key: [] for key in OBS_KEYS}
+
+    def records():
+        files = {}
+        try:
+            for problem_index in feasible_list:
+                shard, offset = cases[problem_index]
+                if shard not in files:
+                    files[shard] = open(shard, 'rb')
+                files[shard].seek(offset)
+                _, record, obs = pickle.load(files[shard])
+                for key in OBS_KEYS:
+                    obs_setting[key].append(obs[key])
+                yield record
+        finally:
+            for f in files.values():
+                f.close()
+
+    write_records(graph_file_path, records())
+    return obs_setting, feasible_list
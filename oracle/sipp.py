@@ -2,6 +2,7 @@ import sys
 sys.path.append('..')
 
 import argparse
+import heapq
 import importlib
 
 from collections import OrderedDict
@@ -15,6 +16,7 @@ from utils import make_gif
 import time
 
 from configs.config import load_config
+from environment.collision import interpolation_order, link_aabbs, aabb_overlap
 
 
 INFINITY = float('inf')
@@ -33,6 +35,7 @@ class SIPP:
         self.k = cfg['env']['unit_timestep']
         self.collision_check = 0
         self.RRT_EPS = cfg['env']['RRT_EPS']
+        self.CC_BISECTION = cfg['env'].get('CC_BISECTION', False)
 
     def get_cfg_obs(self):
         self.speed = 1. / (self.k - 1)
@@ -44,72 +47,77 @@ class SIPP:
 
 
     def get_safe_intervals(self):
-        # safe_intervals {node:[(startTime, endTime), (startTime, endTime),...]}
-        safe_intervals = {}
-        cc = 0
-        for mine in range(len(self.points)):
-            c_mine = self.points[mine]
-            self.env.set_config_mine(c_mine)
-            interval = []
-            prev_t = 0
-            for time in self.time_cfg_obs:
-
-                c_obs = self.time_cfg_obs[time]
-
-                self.env.set_config_obs(c_obs)
-                cc += 1
-                if not self.env.check_collision(): # collision
-                    if time > prev_t:
-                        interval.append((prev_t, time-1))
-                    prev_t = time + 1
-
-                elif time==next(reversed(self.time_cfg_obs)):
-                    interval.append((prev_t, INFINITY))
-
-            safe_intervals[mine] = interval
-        return safe_intervals
-
-    @staticmethod
-    def min_dist(q, dist):
-        """
-        Returns the node with the smallest distance in q.
-        Implemented to keep the main algorithm clean.
         """
-        min_node = None
-        for node in q:
-            if min_node is None:
-                min_node = node
-            elif dist[node] < dist[min_node]:
-                min_node = node
+        safe intervals of every node as compact arrays
+        returns intervals [M, 2] of (startTime, endTime) and offsets [N+1],
+        the safe intervals of node n are intervals[offsets[n]:offsets[n+1]]
 
-        return min_node
+        obstacle time is the outer loop so the obstacles are posed once per time step, nodes whose
+        bounding boxes are clear of the obstacle arms skip the narrow phase at that time step
+        """
+        n_nodes = len(self.points)
+        times = list(self.time_cfg_obs)
+
+        # bounding boxes and the obstacle independent collision of every node
+        mine_aabbs = []
+        mine_free = np.zeros(n_nodes, dtype=bool)
+        for mine in range(n_nodes):
+            self.env.set_config_mine(self.points[mine])
+            mine_free[mine], _ = self.env.check_collision_split()
+            mine_aabbs.append(link_aabbs(self.env.mine_ids, client=self.env.client))
+        mine_aabbs = np.array(mine_aabbs)
+
+        # free[t, node]
+        free = np.zeros((len(times), n_nodes), dtype=bool)
+        for t, time in enumerate(times):
+            self.env.set_config_obs(self.time_cfg_obs[time])
+            _, obs_free = self.env.check_collision_split()
+            if not obs_free:
+                continue
+
+            near = aabb_overlap(mine_aabbs, link_aabbs(self.env.obs_ids, client=self.env.client)) & mine_free
+            free[t] = mine_free & ~near
+            for mine in np.nonzero(near)[0]:
+                self.env.set_config_mine(self.points[mine])
+                free[t, mine] = self.env.check_collision()
+
+        # runs of free time steps of every node
+        padded = np.zeros((n_nodes, len(times) + 2), dtype=np.int8)
+        padded[:, 1:-1] = free.T
+        start_node, start_t = np.nonzero(np.diff(padded, axis=1) == 1)
+        _, end_t = np.nonzero(np.diff(padded, axis=1) == -1)
+
+        intervals = np.stack((start_t, end_t - 1), axis=-1).astype(float)
+        # safe until the end of the obstacle trajectory means safe forever
+        intervals[end_t == len(times), 1] = INFINITY
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(start_node, minlength=n_nodes))))
+        return intervals, offsets
+
+    def node_intervals(self, node):
+        return self.intervals[self.offsets[node]:self.offsets[node + 1]]
 
     def heuristic(self, nodes, edges, costs, source):
         """
         dijkstra search in configuration space without collision check
+        returns an array of the distance from source to every node
         """
-
-        q = set()
-        dist = {}
-
-        for v in nodes:  # initialization
-            dist[v] = INFINITY  # unknown distance from goal to v
-            q.add(v)  # all nodes initially in q (unvisited nodes)
-
-        # distance from goal to every node
+        dist = np.full(len(nodes), INFINITY)
         dist[source] = 0
 
-        while q:
+        heap = [(0., source)]
+        while heap:
             # node with the least distance selected first
-            u = self.min_dist(q, dist)
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                # stale entry, u was already reached with a shorter distance
+                continue
 
-            q.remove(u)
-
-            for index, v in enumerate(edges[u]):
-                alt = dist[u] + costs[u][index]
+            for v, cost in zip(edges[u], costs[u]):
+                alt = d + cost
                 if alt < dist[v]:
                     # a shorter path to v has been found
                     dist[v] = alt
+                    heapq.heappush(heap, (alt, v))
 
         return dist
 
@@ -130,7 +138,7 @@ class SIPP:
                 return False
 
         # mine arm moving
-        for k in range(1, K+1):
+        for k in interpolation_order(K, self.CC_BISECTION):
             c_mine = self.points[src] + k * 1. / K * disp_mine
             self.env.set_config_mine(c_mine)
 
@@ -144,7 +152,7 @@ class SIPP:
 
 
     def get_no_collision_time(self, src, dest, start_t, end_t, interval, mov_time, src_arr_time):
-        overlap_s = max(start_t, interval[0])
+        overlap_s = int(max(start_t, interval[0]))
         overlap_e = min(end_t, interval[1])
         if self.max_time_obs + mov_time <= overlap_s:
             if self.check_edge_collision(src, dest, overlap_s, mov_time, src_arr_time):
@@ -152,7 +160,7 @@ class SIPP:
             else:
                 return None
 
-        for arr_t in range(overlap_s, min(overlap_e+1, self.max_time_obs + mov_time)):
+        for arr_t in range(overlap_s, int(min(overlap_e+1, self.max_time_obs + mov_time))):
             # check collision on the edge
             if self.check_edge_collision(src, dest, arr_t, mov_time, src_arr_time):
                 return arr_t
@@ -166,9 +174,9 @@ class SIPP:
 
             mov_time = int(np.ceil(np.linalg.norm(self.points[src] - self.points[dest]) / self.speed))
             start_t = src_arr_time + mov_time
-            end_t = self.safe_intervals[src][src_interval_idx][1] + mov_time
+            end_t = self.node_intervals(src)[src_interval_idx][1] + mov_time
 
-            for idx, interval in enumerate(self.safe_intervals[dest]):
+            for idx, interval in enumerate(self.node_intervals(dest)):
                 if interval[0]>end_t or interval[1]<start_t:
                     continue
                 arr_t = self.get_no_collision_time(src, dest, start_t, end_t, interval, mov_time, src_arr_time)
@@ -195,14 +203,18 @@ class SIPP:
         else:
             self.goal_idx = len(self.points) - 1
         self.max_time_obs, self.time_cfg_obs = self.get_cfg_obs()
-        self.safe_intervals = self.get_safe_intervals()
+        self.intervals, self.offsets = self.get_safe_intervals()
 
-        if len(self.safe_intervals[self.source_idx])==0 or self.safe_intervals[self.source_idx][0][0] != 0:
+        if len(self.node_intervals(self.source_idx))==0 or self.node_intervals(self.source_idx)[0][0] != 0:
             return False
         else:
             return True
 
-    def path_planning(self, obs_traj, points, edges, edge_cost, source_idx=None, goal_idx=None):
+    def path_planning(self, obs_traj, points, edges, edge_cost, source_idx=None, goal_idx=None, exhaustive=False):
+        """
+        exhaustive: keep expanding until the open list is empty so that arr_time and prev cover every
+                    reachable state, otherwise stop as soon as a goal state is expanded
+        """
 
         if self.check_free_space(obs_traj, points, edges, edge_cost, source_idx, goal_idx) == False:
             return False, 'free_space'
@@ -223,20 +235,29 @@ class SIPP:
         arr_time = {}
         arr_time[(self.source_idx, 0)] = 0
 
-        open = set()
-        open.add((self.source_idx, 0))
+        # heap of (f, state), entries superseded by a lower f are skipped when popped
+        open = [(f[(self.source_idx, 0)], (self.source_idx, 0))]
+        closed = set()
 
         t0 = time.time()
         while open:
-            s = min(open, key=lambda node:f[node])
-            open.remove(s)
+            f_s, s = heapq.heappop(open)
+            if s in closed or f_s > f[s]:
+                continue
+            closed.add(s)
 
             s_index, s_interval_idx = s
+            if s_index == self.goal_idx and not exhaustive:
+                # popped with the least f, the heuristic is consistent so its arrival time is optimal
+                break
+
             s_arr_t = arr_time[s]
             succs = self.get_successors(self.edges, s_index, s_interval_idx, s_arr_t)
             for item in succs:
                 succ_idx, succ_interval_idx, succ_arr_t = item
                 succ = (succ_idx, succ_interval_idx)
+                if succ in closed:
+                    continue
                 if succ not in f.keys():
                     f[succ] = INFINITY
                     g[succ] = INFINITY
@@ -245,7 +266,7 @@ class SIPP:
                     g[succ] = succ_arr_t
                     arr_time[succ] = succ_arr_t
                     f[succ] = g[succ]+ h[succ_idx]
-                    open.add(succ)
+                    heapq.heappush(open, (f[succ], succ))
 
 
         if self.goal_idx not in [n[0] for n in arr_time.keys()]:
@@ -255,11 +276,11 @@ class SIPP:
             feasible = True
             path = self.generatePath(arr_time, prev)
 
-        return arr_time, prev, self.safe_intervals, path, feasible, path[-1][-1], self.collision_check
+        return arr_time, prev, (self.intervals, self.offsets), path, feasible, path[-1][-1], self.collision_check
 
     def generatePath(self, arr_time, prev):
         path = []
-        for i in range(len(self.safe_intervals[self.goal_idx])):
+        for i in range(len(self.node_intervals(self.goal_idx))):
             goal = (self.goal_idx, i)
             if goal in arr_time.keys():
                 path = [(self.goal_idx, arr_time[goal])]
@@ -300,7 +321,7 @@ class SIPP:
                     print("COLLIDE waiting!!!\n")
                 if make_gif:
                     gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=self.env.client)[2])
 
             current_time = time[current_state + 1] - mov_time
 
@@ -320,7 +341,7 @@ class SIPP:
                     print("COLLIDE moving!!!\n")
                 if make_gif:
                     gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                                 renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=self.env.client)[2])
 
             current_state += 1  # moved to the next state
 
@@ -370,7 +391,7 @@ def plot_sipp(env, points, sipp_path, obs_traj, make_gif=False):
                 print("COLLIDE waiting!!!\n")
             if make_gif:
                 gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                             renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                             renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=env.client)[2])
 
         current_time = time[current_state + 1] - mov_time
 
@@ -390,7 +411,7 @@ def plot_sipp(env, points, sipp_path, obs_traj, make_gif=False):
                 print("COLLIDE moving!!!\n")
             if make_gif:
                 gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                             renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                             renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=env.client)[2])
 
         current_state += 1  # moved to the next state
 
@@ -427,7 +448,7 @@ def plot_traj(env, traj_path, init_mine, end_mine, make_gif=False):
 
             if make_gif:
                 gifs.append(p.getCameraImage(width=1080, height=720, lightDirection=[0, 0, -1], shadow=0,
-                                             renderer=p.ER_BULLET_HARDWARE_OPENGL)[2])
+                                             renderer=p.ER_BULLET_HARDWARE_OPENGL, physicsClientId=env.client)[2])
 
         current_state += 1  # moved to the next state
 
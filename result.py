@@ -1,12 +1,14 @@
-import pickle
 import numpy as np
 
+from dataset import is_packed, load_records, read_record, PackedDataset
+
 def show_result(model_name, gt_file=None, result_dict=None, result_file=None, index_list=None):
     graphs = []
-    for file_idx in range(len(gt_file)):
-        with open(gt_file[file_idx], 'rb') as f:
-            load_graph = pickle.load(f)
-            graphs.extend(load_graph)
+    if is_packed(gt_file[0]):
+        graphs = PackedDataset(gt_file[0])
+    else:
+        for file_idx in range(len(gt_file)):
+            graphs.extend(load_records(gt_file[file_idx]))
 
 
     if index_list is not None:
@@ -15,8 +17,9 @@ def show_result(model_name, gt_file=None, result_dict=None, result_file=None, in
     gt_time = []
     gt_collision_checking = []
     for item in graphs:
-        gt_time.append(item[-2])
-        gt_collision_checking.append(item[-1])
+        record = read_record(item)
+        gt_time.append(record['end_time'])
+        gt_collision_checking.append(record['collision_check'])
 
     gt_time = np.array(gt_time)
 
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+
+from dataset import read_record, make_record, write_records, load_records, pack_dataset, PackedDataset, LazyDataset, \
+    INDEX_SUFFIX
+
+
+def baseline_voxel_record():
+    # as appended by the baseline kuka, 3kuka and 3arms generators
+    points = np.random.uniform(size=(5, 3))
+    edge_index = np.array([[0, 1], [1, 4]])
+    half_extents, base_positions = [np.array([0.1, 0.1, 0.1])], [np.array([0.5, 0., 0.2])]
+    arr_time, prev, safe_intervals = np.zeros(5), -np.ones(5), [[(0, np.inf)]] * 5
+    path = [(0, 0), (1, 3), (4, 7)]
+    plan_time, end_time, collision_check = 0.25, 7, 42
+    return (points, edge_index, half_extents, base_positions, arr_time, prev, safe_intervals, path, plan_time,
+            end_time, collision_check)
+
+
+def test_read_baseline_voxel_record():
+    legacy = baseline_voxel_record()
+    record = read_record(legacy)
+
+    assert record['plan_time'] == 0.25
+    assert record['feasible'] is True
+    assert record['path'] == legacy[7]
+    assert record['end_time'] == 7 and record['collision_check'] == 42
+    assert record['half_extents'] is legacy[2] and record['base_positions'] is legacy[3]
+    assert read_record(record) is record
+
+
+def test_read_baseline_record():
+    points, edge_index = np.random.uniform(size=(4, 2)), np.array([[0, 3]])
+    legacy = (points, edge_index, np.zeros(4), -np.ones(4), None, [(0, 0), (3, 2)], True, 2, 10)
+    record = read_record(legacy)
+
+    assert record['feasible'] is True and record['plan_time'] is None
+    assert record['end_time'] == 2 and record['collision_check'] == 10
+
+
+def test_record_stream_round_trip(tmp_path):
+    records = [baseline_voxel_record(), make_record(np.zeros((2, 3)), np.array([[0, 1]]), [(0, 0), (1, 1)],
+                                                    False, 1, 3)]
+    path = str(tmp_path / 'graphs.pkl')
+    write_records(path, records)
+
+    loaded = [read_record(record) for record in load_records(path)]
+    assert loaded[0]['plan_time'] == 0.25 and loaded[0]['feasible']
+    assert not loaded[1]['feasible'] and loaded[1]['plan_time'] is None
+
+
+def test_pack_keeps_plan_time(tmp_path):
+    graph_path, obs_path = str(tmp_path / 'graphs.pkl'), str(tmp_path / 'obs.npz')
+    legacy = baseline_voxel_record()
+    voxel_record = make_record(np.zeros((2, 3)), np.array([[0, 1]]), [(0, 0)], True, 1, 3,
+                               [np.array([0.2, 0.2, 0.2])], [np.array([0., 0.5, 0.])])
+    write_records(graph_path, [legacy, voxel_record])
+    np.savez(obs_path, init_states=np.zeros((2, 3)), goal_states=np.ones((2, 3)))
+
+    pack_dataset([graph_path], [obs_path], str(tmp_path / 'packed'))
+    packed = PackedDataset(str(tmp_path / 'packed'))
+
+    assert len(packed) == 2
+    assert packed[0]['plan_time'] == 0.25 and packed[0]['feasible']
+    assert packed[-1]['plan_time'] is None
+    assert packed[0]['path'] == legacy[7]
+
+
+def test_lazy_dataset_reads_single_records(tmp_path):
+    path = str(tmp_path / 'graphs.pkl')
+    write_records(path, [baseline_voxel_record() for _ in range(3)])
+
+    with LazyDataset([path], cache_size=2) as graphs:
+        assert len(graphs) == 3 and graphs.feasible.all()
+        assert read_record(graphs[-1])['plan_time'] == 0.25
+        assert graphs[2] is graphs[-1]
+        graphs[0], graphs[1]
+        assert list(graphs.records) == [0, 1]
+
+
+def test_stream_without_index_is_rejected(tmp_path):
+    path = str(tmp_path / 'graphs.pkl')
+    write_records(path, [baseline_voxel_record() for _ in range(2)])
+    os.remove(path + INDEX_SUFFIX)
+
+    with pytest.raises(RuntimeError):
+        load_records(path)
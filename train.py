@@ -5,11 +5,14 @@ import os
 import torch
 import numpy as np
 from torch_geometric.data import Data
+from torch_geometric.loader import DataLoader
+from torch_scatter import scatter_logsumexp
 from configs.config import set_random_seed, load_config
 from tqdm import tqdm as tqdm
 
-from model import GNNet, TemporalEncoder, PolicyHead
-from utils import load_dataset, load_path_time
+from model import GNNet, TemporalEncoder, PolicyHead, edge_csr
+from utils import load_dataset, load_path_time, cache_obs_points
+from dataset import read_record, feasible_flags
 
 parser = argparse.ArgumentParser(description='GNN-Dynamic')
 parser.add_argument('--yaml_file', type=str, default='configs/2arms.yaml',
@@ -19,6 +22,44 @@ args = parser.parse_args()
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+
+class ProblemDataset(torch.utils.data.Dataset):
+    """
+    Feasible training problems as PyG graphs, loading a problem sets the environment to it.
+    The environment is shared, so the loader has to run in the main process (num_workers=0).
+    """
+    def __init__(self, env, graphs, obs_setting):
+        self.env = env
+        self.graphs = graphs
+        self.obs_setting = obs_setting
+        self.indexes = np.flatnonzero(feasible_flags(graphs)).tolist()
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, idx):
+        index = self.indexes[idx]
+        self.env.init_new_problem(index=index, setting_dict=self.obs_setting)
+
+        record = read_record(self.graphs[index])
+        points = record['points']
+        edge_index = record['edge_index']
+        path_time = load_path_time(record['path'], 'cpu').long()
+
+        data = Data(v=torch.FloatTensor(points), edge_index=torch.LongTensor(edge_index.T))
+        data.num_nodes = len(points)
+
+        labels = torch.zeros(len(points), 1)
+        labels[-1, 0] = 1
+        data.labels = labels
+
+        data.obstacles = torch.FloatTensor(self.env.obs_points)[None, :, :]
+        # node ids along the path are shifted by PyG when batching since the key contains 'index'
+        data.path_index = path_time[:, 0]
+        data.path_tick = path_time[:, 1]
+        return data
+
+
 class Trainer():
     def __init__(self, cfg):
         Env = importlib.import_module('environment.' + cfg['env']['env_name'] + '_env')
@@ -33,6 +74,10 @@ class Trainer():
 
         self.data_path_graph = cfg['data']['training_files_graph']
         self.data_path_obs = cfg['data']['training_files_obs']
+        self.lazy_load = cfg['data'].get('lazy_load', False)
+        self.lazy_cache_size = cfg['data'].get('lazy_cache_size', 0)
+        if cfg['data'].get('cache_obs_points', False):
+            cache_obs_points(self.env, self.data_path_obs)
 
         self.model_gnn_path = cfg['train']['output_model_gnn_path']
         self.model_head_path = cfg['train']['output_model_head_path']
@@ -43,6 +88,9 @@ class Trainer():
 
         self.epochs = cfg['train']['epochs']
         self.lr = cfg['train']['lr']
+        # batch_size=1: one graph per forward with gradients accumulated over 10 graphs,
+        # batch_size>1 (opt-in): mini-batches of graphs with an optimizer step per batch
+        self.batch_size = cfg['train'].get('batch_size', 1)
 
 
         self.model_gnn = GNNet(config_size=self.dof, embed_size=self.embed_size, obs_size=self.obs_size, use_obstacles=True).to(device)
@@ -51,10 +99,98 @@ class Trainer():
         self.te_head = TemporalEncoder(embed_size=self.obs_size).to(device)
 
 
+    def policy_loss(self, edge_feat, rowptr, col, path_index, path_tick, path_batch, obstacles):
+        """
+        Cross entropy of the ground-truth next node over the outgoing edges of every path step,
+        all steps of all graphs are evaluated in one PolicyHead call and a segment log-softmax.
+        path_index/path_tick/path_batch: node, time tick and graph of every path entry
+        obstacles: [K, T, obs_size]
+        """
+        # a step goes from a path entry to the next entry of the same graph
+        same = path_batch[1:] == path_batch[:-1]
+        source = path_index[:-1][same]
+        end = path_index[1:][same]
+        tick = path_tick[:-1][same]
+        step_graph = path_batch[:-1][same]
+
+        # candidate edges of every step, i.e. the CSR rows of the source nodes
+        deg = rowptr[source + 1] - rowptr[source]
+        step = torch.repeat_interleave(torch.arange(len(source), device=deg.device), deg)
+        first = torch.cumsum(deg, dim=0) - deg
+        edge = rowptr[source][step] + torch.arange(len(step), device=deg.device) - first[step]
+
+        # obstacle window around the time tick of every step
+        offsets = torch.arange(-self.half_win_len, self.half_win_len + 1, device=tick.device)
+        time_window = torch.clip(tick[:, None] + offsets, 0, obstacles.shape[1] - 1)
+        obs = obstacles[step_graph[:, None], time_window].flatten(1)
+        tmp_enc_tw = self.te_head(time_window).flatten(1)
+
+        policy = self.model_head(edge_feat[edge], obs, tmp_enc_tw, index=step).flatten()
+        log_policy = policy - scatter_logsumexp(policy, step, dim=0, dim_size=len(source))[step]
+
+        # first candidate edge leading to the ground-truth next node of every step
+        match = torch.nonzero(col[edge] == end[step]).flatten()
+        first_match = torch.ones_like(match, dtype=torch.bool)
+        first_match[1:] = step[match][1:] != step[match][:-1]
+        match = match[first_match]
+        assert len(match) == len(source), 'next path node is not a neighbor of the current node'
+        return -log_policy[match].sum()  # a variant of the cross entropy
+
+    def train_minibatch(self, graphs, obs_setting):
+        dataset = ProblemDataset(self.env, graphs, obs_setting)
+        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True, follow_batch=['path_index'])
+
+        self.model_gnn.train()
+        self.model_head.train()
+        optimizer = torch.optim.Adam(list(self.model_gnn.parameters()) + list(self.model_head.parameters()), lr=self.lr)
+
+        for epoch in range(self.epochs):
+            pbar = tqdm(loader, desc=f"Epoch {int(epoch)}/{self.epochs}", )
+
+            for batch in pbar:
+                batch = batch.to(device)
+                current_loop = np.random.randint(1, self.loop)
+
+                ## get temporal encoding
+                x = torch.arange(batch.obstacles.shape[1])
+                pe = self.te_gnn(x).to(device)
+
+                csr = edge_csr(batch.edge_index, len(batch.v))
+
+                #### Stage1: Global Encoding ####
+                (rowptr, col, edge_feat), node_feat = self.model_gnn(v=batch.v, labels=batch.labels,
+                                                                obstacles=batch.obstacles, pos_enc=pe,
+                                                                edge_index=batch.edge_index, batch=batch.batch,
+                                                                loop=current_loop, sparse=True, csr=csr)
+
+                #### Stage2: Local Planning ####
+                policy_loss = self.policy_loss(edge_feat, rowptr, col, batch.path_index, batch.path_tick,
+                                               batch.path_index_batch, batch.obstacles)
+
+                optimizer.zero_grad()
+                policy_loss.backward()
+                optimizer.step()
+
+                pbar.set_description(f"Epoch {int(epoch)}/{self.epochs}, %.2f" % (policy_loss.item() / batch.num_graphs))
+
+            torch.save(self.model_gnn.state_dict(), self.model_gnn_path)
+            torch.save(self.model_head.state_dict(), self.model_head_path)
+            # save model
+            if (epoch + 1) % 20 == 0:
+                torch.save(self.model_gnn.state_dict(), self.model_gnn_path[:-3] + f'_epoch_{epoch}.pt')
+                torch.save(self.model_head.state_dict(), self.model_head_path[:-3] + f'_epoch_{epoch}.pt')
+
+        torch.save(self.model_gnn.state_dict(), self.model_gnn_path)
+        torch.save(self.model_head.state_dict(), self.model_head_path)
+
     def train(self):
         set_random_seed(1234)
 
-        graphs, obs_setting = load_dataset(self.data_path_graph, self.data_path_obs)
+        graphs, obs_setting = load_dataset(self.data_path_graph, self.data_path_obs, lazy=self.lazy_load,
+                                           cache_size=self.lazy_cache_size)
+
+        if self.batch_size > 1:
+            return self.train_minibatch(graphs, obs_setting)
 
         T = 0
         losses = []
@@ -72,14 +208,15 @@ class Trainer():
             for index in pbar:
                 self.env.init_new_problem(index=index, setting_dict=obs_setting)
 
-                points = graphs[index][0]
-                edge_index = graphs[index][1]
-                path_time = graphs[index][-4]
-                feasible = graphs[index][-3]
+                record = read_record(graphs[index])
+                points = record['points']
+                edge_index = record['edge_index']
+                path_time = record['path']
+                feasible = record['feasible']
 
-                if len(graphs[index]) == 11:
-                    halfExtents_list = graphs[index][2]
-                    basePosition_list = graphs[index][3]
+                if record['half_extents'] is not None:
+                    halfExtents_list = record['half_extents']
+                    basePosition_list = record['base_positions']
                     for halfExtents, basePosition in zip(halfExtents_list, basePosition_list):
                         self.env.create_voxel(halfExtents, basePosition)
 
@@ -108,45 +245,31 @@ class Trainer():
                 x = torch.arange(len(self.env.obs_points))
                 pe = self.te_gnn(x).to(device)
 
+                csr = edge_csr(data.edge_index.to(device), len(data.v))
+
                 #### Stage1: Global Encoding ####
-                edge_feat, node_feat = self.model_gnn(**data.to(device).to_dict(),
-                                                 labels=labels.to(device),
-                                                 pos_enc=pe,
-                                                 obstacles=torch.FloatTensor(self.env.obs_points).to(device),
-                                                 loop=current_loop)
+                (rowptr, col, edge_feat), node_feat = self.model_gnn(**data.to(device).to_dict(),
+                                                                labels=labels.to(device),
+                                                                pos_enc=pe,
+                                                                obstacles=torch.FloatTensor(self.env.obs_points).to(device),
+                                                                loop=current_loop, sparse=True, csr=csr)
 
                 #### Stage2: Local Planning ####
-                policy_loss = 0
-                for step in range(path_time.shape[0] - 1):
-                    source = path_time[step, 0]
-                    end = path_time[step + 1, 0]
-
-                    nonzero_indices = torch.where(edge_feat[source, :, :] != 0)[0].unique()
-                    edges = edge_feat[source, nonzero_indices, :]
-
-                    # edge:[N, embed_size],  obs:[N, obs_size]
-                    time_window = list(range(-self.half_win_len, self.half_win_len+1))
-                    offsets = torch.LongTensor(time_window).to(device)
-                    time_window = torch.clip(path_time[step, 1] + offsets, 0, self.env.obs_points.shape[0] - 1)
-                    obs = torch.FloatTensor(self.env.obs_points)[time_window].flatten()[None, :].repeat(edges.shape[0],
-                                                                                                   1).to(device)
-                    tmp_enc_tw = self.te_head(time_window).flatten()[None, :].repeat(edges.shape[0], 1).to(device)
-
-                    policy = self.model_head(edges, obs, tmp_enc_tw)  # [N, 32*4]
-                    policy_loss += -policy.log_softmax(dim=0)[torch.where(nonzero_indices == end)][
-                        0]  # a variant of the cross entropy
+                policy_loss = self.policy_loss(edge_feat, rowptr, col, path_time[:, 0].long(), path_time[:, 1].long(),
+                                               torch.zeros(len(path_time), dtype=torch.long, device=device),
+                                               torch.FloatTensor(self.env.obs_points)[None, :, :].to(device))
 
                 policy_loss.backward()
-                losses.append((policy_loss))
-                epoch_losses.append(policy_loss)
+                losses.append(policy_loss.item())
+                epoch_losses.append(policy_loss.item())
 
                 if T % 10 == 0:
                     optimizer.step()
                     optimizer.zero_grad()
 
-                    total_loss = [sum([loss[i] for loss in losses]) / len(losses) for i in range(1)]
+                    total_loss = sum(losses) / len(losses)
 
-                    pbar.set_description(f"Epoch {int(epoch)}/{self.epochs}, %.2f" % total_loss[0])
+                    pbar.set_description(f"Epoch {int(epoch)}/{self.epochs}, %.2f" % total_loss)
 
                     losses = []
 
@@ -1,7 +1,11 @@
 from PIL import Image
 import numpy as np
+import os
 import pickle
 import torch
+from torch_sparse import coalesce
+
+from dataset import is_packed, is_stream, load_records, PackedDataset, LazyDataset
 
 def make_gif(gifs, path, duration=50, loop=0):
     a_frames = []
@@ -28,7 +32,18 @@ def to_np(tensor):
     return tensor.data.cpu().numpy()
 
 
-def load_dataset(data_path_graph, data_path_obs):
+def load_dataset(data_path_graph, data_path_obs, lazy=False, cache_size=0):
+    """
+    lazy: read a record only when its problem is indexed, the pkl files have to be record streams
+    cache_size: number of decoded records a lazy dataset keeps in memory
+    """
+    # packed dataset, memory-mapped instead of unpickled
+    if is_packed(data_path_graph[0]):
+        assert len(data_path_graph) == 1
+        graphs = PackedDataset(data_path_graph[0])
+        print(f'{data_path_graph[0]} loaded')
+        return graphs, graphs.obs_setting()
+
     graphs = []
 
     init_states_list = []
@@ -36,6 +51,7 @@ def load_dataset(data_path_graph, data_path_obs):
     obs_pos_list = []
     obs_ori_list = []
     obs_traj_list = []
+    obs_points_list = []
     obs_setting = {}
 
     ### load testcase and SIPP result ####
@@ -46,22 +62,93 @@ def load_dataset(data_path_graph, data_path_obs):
             obs_pos_list.append(f['obs_pos'])
             obs_ori_list.append(f['obs_ori'])
             obs_traj_list.append(f['obs_traj'])
+            if 'obs_points' in f:
+                obs_points_list.append(f['obs_points'])
 
         print(f'{data_path_obs[file_idx]} loaded')
 
-        with open(data_path_graph[file_idx], 'rb') as f:
-            load_graph = pickle.load(f)
-            graphs.extend(load_graph)
+        if lazy:
+            continue
+        graphs.extend(load_records(data_path_graph[file_idx]))
         print(f'{data_path_graph[file_idx]} loaded')
 
+    if lazy:
+        graphs = LazyDataset(data_path_graph, cache_size)
+
     obs_setting['init_states'] = np.concatenate(init_states_list)
     obs_setting['goal_states'] = np.concatenate(goal_states_list)
     obs_setting['obs_pos'] = np.concatenate(obs_pos_list)
     obs_setting['obs_ori'] = np.concatenate(obs_ori_list)
     obs_setting['obs_traj'] = np.concatenate(obs_traj_list)
+    # workspace points of the obstacle trajectories, only when every file has them
+    if len(obs_points_list) == len(data_path_obs):
+        obs_setting['obs_points'] = np.concatenate(obs_points_list)
 
     return graphs, obs_setting
 
+def num_problems(data_path_graph, data_path_obs):
+    """
+    Number of problems of a dataset without loading its records
+    """
+    if is_packed(data_path_graph[0]):
+        return len(PackedDataset(data_path_graph[0]))
+    total = 0
+    for path in data_path_obs:
+        with np.load(path) as f:
+            total += len(f['init_states'])
+    return total
+
+def can_load_lazily(data_path_graph):
+    return is_packed(data_path_graph[0]) or all(is_stream(path) for path in data_path_graph)
+
+def compute_obs_points(env, obs_setting, indexes=None):
+    """
+    Workspace points of the obstacle trajectories of the problems in indexes (default all), [N, T, workspace_dim].
+    Only the obstacle base is moved between problems, the scene is not loaded for every problem.
+    """
+    if indexes is None:
+        indexes = range(len(obs_setting['obs_traj']))
+    obs_points = []
+    for index in indexes:
+        env.resetBaseOrientation(obs_setting['obs_pos'][index], obs_setting['obs_ori'][index])
+        obs_points.append(env.get_obs_points(obs_setting['obs_traj'][index]))
+    return np.array(obs_points)
+
+def cache_obs_points(env, data_path_obs):
+    """
+    Add the workspace points of the obstacle trajectories to the obstacle files that do not have them yet,
+    so that env.init_new_problem reads them instead of recomputing them on every load.
+    A file is replaced only once its new version is completely written.
+    """
+    for path in data_path_obs:
+        if is_packed(path):
+            continue
+        with np.load(path) as f:
+            if 'obs_points' in f:
+                continue
+            obs_setting = dict(f)
+
+        obs_setting['obs_points'] = compute_obs_points(env, obs_setting)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **obs_setting)
+        os.replace(tmp_path, path)
+        print(f'{path} obs_points cached')
+
+def load_time_windows(obs_points, half_win_len, te_head, device):
+    """
+    Obstacle workspace points and temporal encodings of the time window around every time tick,
+    flattened to [T + half_win_len, (2 * half_win_len + 1) * obs_size].
+    Windows of later ticks are all equal to the last row.
+    """
+    num_ticks = len(obs_points)
+    ticks = torch.arange(num_ticks + half_win_len, device=device)
+    offsets = torch.arange(-half_win_len, half_win_len + 1, device=device)
+    time_window = torch.clip(ticks[:, None] + offsets, 0, num_ticks - 1)
+
+    obs = torch.FloatTensor(obs_points).to(device)[time_window].flatten(1)
+    tmp_enc = te_head(time_window).flatten(1)
+    return obs, tmp_enc
+
 def load_path_time(input_path_time, device):
     gt_path = [x[0] for x in input_path_time]
     gt_time = [x[1] for x in input_path_time]
@@ -79,3 +166,60 @@ def load_path_time(input_path_time, device):
     path_time = path_time.int()
 
     return path_time
+
+
+class KnnGraph():
+    """
+    Bi-directional kNN graph with self loops (as knn_graph + coalesce) that grows by inserting new
+    samples before the goal node. The k nearest neighbors of every node are kept across insertions,
+    so growing the graph only computes distances to the new points.
+    """
+    def __init__(self, points, k=50, device='cpu'):
+        self.k = k
+        self.points = torch.as_tensor(points, dtype=torch.float, device=device)
+        dist = torch.cdist(self.points, self.points)
+        self.knn_dist, self.knn = dist.topk(min(k, len(self.points)), dim=-1, largest=False)
+
+    def edge_index(self):
+        num_nodes = len(self.points)
+        col = torch.arange(num_nodes, device=self.knn.device).repeat_interleave(self.knn.shape[1])
+        edge_index = torch.stack((self.knn.flatten(), col))
+        edge_index = torch.cat((edge_index, edge_index.flip(0)), dim=-1)
+        edge_index, _ = coalesce(edge_index, None, num_nodes, num_nodes)
+        return edge_index
+
+    def insert(self, new_points):
+        """
+        Insert new_points between the current nodes and the goal (last) node,
+        returns the new indices of the previous nodes
+        """
+        new_points = torch.as_tensor(new_points, dtype=torch.float, device=self.points.device)
+        new_points = new_points.view(-1, self.points.shape[1])
+        num_old, num_new = len(self.points), len(new_points)
+        goal = num_old - 1
+        points = torch.cat((self.points[:-1], new_points, self.points[-1:]), dim=0)
+
+        # the goal moves behind the new points
+        knn = torch.where(self.knn == goal, self.knn + num_new, self.knn)
+        new_idx = torch.arange(goal, goal + num_new, device=knn.device)
+        old_idx = torch.cat((torch.arange(goal, device=knn.device), new_idx[-1:] + 1))
+
+        # distances between all nodes and the new points only
+        dist = torch.cdist(points, new_points)
+        k = min(self.k, len(points))
+
+        # neighbors of the new points
+        new_knn_dist, new_knn = dist.T.topk(k, dim=-1, largest=False)
+
+        # neighbors of the old points, only changed where a new point is closer than the k-th neighbor
+        cand_dist = torch.cat((self.knn_dist, dist[old_idx]), dim=-1)
+        cand = torch.cat((knn, new_idx.expand(num_old, num_new)), dim=-1)
+        old_knn_dist, pos = cand_dist.topk(k, dim=-1, largest=False)
+        old_knn = cand.gather(1, pos)
+
+        self.points = points
+        self.knn = torch.cat((old_knn[:-1], new_knn, old_knn[-1:]), dim=0)
+        self.knn_dist = torch.cat((old_knn_dist[:-1], new_knn_dist, old_knn_dist[-1:]), dim=0)
+
+        # index of every previous node in the grown graph
+        return old_idx